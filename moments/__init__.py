@@ -9,8 +9,10 @@ from moments.core.commands import register_commands
 from moments.core.errors import register_error_handlers
 from moments.core.extensions import avatars, bootstrap, csrf, db, dropzone, login_manager, mail, whooshee
 from moments.core.logging import register_logging
+from moments.core.pool import init_pool
 from moments.core.request import register_request_handlers
 from moments.core.templating import register_template_handlers
+from moments.models import check_sqlite_pragmas
 from moments.settings import config
 
 
@@ -20,6 +22,7 @@ def create_app(config_name):
     app.config.from_object(config[config_name])
 
     bootstrap.init_app(app)
+    init_pool(app)
     db.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
@@ -39,5 +42,6 @@ def create_app(config_name):
     register_template_handlers(app)
     register_request_handlers(app)
     register_error_handlers(app)
+    check_sqlite_pragmas(app)
 
     return app
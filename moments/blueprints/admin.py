@@ -3,9 +3,12 @@ from flask_login import login_required
 from sqlalchemy import func, select
 
 from moments.core.extensions import db
+from moments.core.pool import get_pool_stats
+from moments.core.templating import get_fragment_cache_stats
 from moments.decorators import admin_required, permission_required
 from moments.forms.admin import EditProfileAdminForm
 from moments.models import Comment, Photo, Role, Tag, User
+from moments.pagination import CursorPagination, paginate
 from moments.utils import redirect_back
 
 admin_bp = Blueprint('admin', __name__)
@@ -36,6 +39,20 @@ def index():
     )
 
 
+@admin_bp.route('/pool-stats')
+@login_required
+@admin_required
+def pool_stats():
+    return get_pool_stats()
+
+
+@admin_bp.route('/fragment-cache-stats')
+@login_required
+@admin_required
+def fragment_cache_stats():
+    return get_fragment_cache_stats(current_app)
+
+
 @admin_bp.route('/profile/<int:user_id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -133,7 +150,6 @@ def delete_tag(tag_id):
 @permission_required('MODERATE')
 def manage_user():
     filter_rule = request.args.get('filter', 'all')  # 'all', 'locked', 'blocked', 'administrator', 'moderator'
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_MANAGE_USER_PER_PAGE']
     administrator = db.session.scalar(select(Role).filter_by(name='Administrator'))
     moderator = db.session.scalar(select(Role).filter_by(name='Moderator'))
@@ -149,7 +165,7 @@ def manage_user():
     else:
         filtered_users = select(User)
 
-    pagination = db.paginate(filtered_users.order_by(User.member_since.desc()), page=page, per_page=per_page)
+    pagination = paginate(filtered_users, User.member_since, User.id, per_page=per_page)
     users = pagination.items
     return render_template('admin/manage_user.html', pagination=pagination, users=users)
 
@@ -163,11 +179,11 @@ def manage_photo(order):
     per_page = current_app.config['MOMENTS_MANAGE_PHOTO_PER_PAGE']
     order_rule = 'flag'
     if order == 'by_time':
-        pagination = db.paginate(select(Photo).order_by(Photo.created_at.desc()), page=page, per_page=per_page, error_out=False)
+        pagination = paginate(select(Photo), Photo.created_at, Photo.id, per_page=per_page, error_out=False)
         order_rule = 'time'
     else:
-        pagination = db.paginate(select(Photo).order_by(Photo.flag.desc()), page=page, per_page=per_page, error_out=False)
-    if page > pagination.pages:
+        pagination = paginate(select(Photo), Photo.flag, Photo.id, per_page=per_page, error_out=False)
+    if not isinstance(pagination, CursorPagination) and page > pagination.pages:
         return redirect(url_for('.manage_photo', page=pagination.pages, order_rule=order_rule))
     photos = pagination.items
     return render_template('admin/manage_photo.html', pagination=pagination, photos=photos, order_rule=order_rule)
@@ -177,9 +193,8 @@ def manage_photo(order):
 @login_required
 @permission_required('MODERATE')
 def manage_tag():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_MANAGE_TAG_PER_PAGE']
-    pagination = db.paginate(select(Tag).order_by(Tag.id.desc()), page=page, per_page=per_page)
+    pagination = paginate(select(Tag), Tag.id, per_page=per_page)
     tags = pagination.items
     return render_template('admin/manage_tag.html', pagination=pagination, tags=tags)
 
@@ -193,11 +208,11 @@ def manage_comment(order):
     per_page = current_app.config['MOMENTS_MANAGE_COMMENT_PER_PAGE']
     order_rule = 'flag'
     if order == 'by_time':
-        pagination = db.paginate(select(Comment).order_by(Comment.created_at.desc()), page=page, per_page=per_page, error_out=False)
+        pagination = paginate(select(Comment), Comment.created_at, Comment.id, per_page=per_page, error_out=False)
         order_rule = 'time'
     else:
-        pagination = db.paginate(select(Comment).order_by(Comment.flag.desc()), page=page, per_page=per_page, error_out=False)
-    if page > pagination.pages:
+        pagination = paginate(select(Comment), Comment.flag, Comment.id, per_page=per_page, error_out=False)
+    if not isinstance(pagination, CursorPagination) and page > pagination.pages:
         return redirect(url_for('.manage_comment', page=pagination.pages, order_rule=order_rule))
     comments = pagination.items
     return render_template('admin/manage_comment.html', pagination=pagination, comments=comments, order_rule=order_rule)
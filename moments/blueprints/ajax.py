@@ -1,10 +1,12 @@
-from flask import Blueprint, render_template, abort
+import queue
+
+from flask import Blueprint, Response, abort, current_app, render_template
 from flask_login import current_user
-from sqlalchemy import func, select
+from sqlalchemy import select
 
 from moments.core.extensions import db
-from moments.models import Notification, Photo, User
-from moments.notifications import push_collect_notification, push_follow_notification
+from moments.models import Photo, User
+from moments.notifications import format_event, notification_hub, push_collect_notification, push_follow_notification
 
 ajax_bp = Blueprint('ajax', __name__)
 
@@ -14,9 +16,47 @@ def notifications_count():
     if not current_user.is_authenticated:
         return {'message': 'Login required.'}, 403
 
-    stmt = current_user.notifications.select().filter_by(is_read=False).with_only_columns(func.count())
-    count = db.session.scalar(stmt)
-    return {'count': count}
+    return {'count': current_user.unread_notifications}
+
+
+@ajax_bp.route('/notifications-stream')
+def notifications_stream():
+    """Stream the notification events of the current user as Server-Sent Events.
+
+    The stream ends after `MOMENTS_NOTIFICATION_STREAM_TIMEOUT` seconds and the browser
+    reconnects, so a worker is never held forever. It is only served when
+    `MOMENTS_NOTIFICATION_STREAM` is on, otherwise the pages poll the count.
+    """
+    if not current_app.config['MOMENTS_NOTIFICATION_STREAM']:
+        abort(404)
+    if not current_user.is_authenticated:
+        return {'message': 'Login required.'}, 403
+
+    user_id = current_user.id
+    count = current_user.unread_notifications
+    keepalive = current_app.config['MOMENTS_NOTIFICATION_KEEPALIVE']
+    timeout = current_app.config['MOMENTS_NOTIFICATION_STREAM_TIMEOUT']
+
+    def stream():
+        # subscribe once the stream is read, a generator closed before it starts never
+        # runs its `finally`
+        events = notification_hub.subscribe(user_id)
+        try:
+            yield format_event('count', {'count': count})
+            for _ in range(max(timeout // keepalive, 1)):
+                try:
+                    event, data = events.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                else:
+                    yield format_event(event, data)
+        finally:
+            notification_hub.unsubscribe(user_id, events)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # disable Nginx buffering
+    return response
 
 
 @ajax_bp.route('/profile/<int:user_id>')
@@ -1,50 +1,63 @@
-from flask import Blueprint, abort, current_app, flash, redirect, render_template, request, send_from_directory, url_for
+import os
+from pathlib import Path
+
+from flask import Blueprint, abort, current_app, flash, redirect, render_template, request, url_for
 from flask_login import current_user, login_required
-from sqlalchemy import func, select
+from sqlalchemy import select
 from sqlalchemy.orm import with_parent
+from werkzeug.security import safe_join
 
+from moments.cache import add_cache_tags, cache_response
 from moments.core.extensions import db
-from moments.decorators import confirm_required, permission_required
+from moments.decorators import confirm_required, permission_required, primary_only
 from moments.forms.main import CommentForm, DescriptionForm, TagForm
-from moments.models import Collection, Comment, Follow, Notification, Photo, Tag, User
-from moments.notifications import push_collect_notification, push_comment_notification
-from moments.utils import flash_errors, redirect_back, rename_image, resize_image, validate_image
+from moments.models import Collection, Comment, Notification, Photo, Tag, Timeline, User
+from moments.notifications import (
+    delete_notifications,
+    publish_notifications_count,
+    push_collect_notification,
+    push_comment_notification,
+    read_notifications,
+)
+from moments.pagination import paginate
+from moments.sampling import sample_rows
+from moments.tasks import process_photo
+from moments.utils import flash_errors, is_unique_filename, redirect_back, rename_image, send_image, validate_image
 
 main_bp = Blueprint('main', __name__)
 
 
 @main_bp.route('/')
+@cache_response
 def index():
     if current_user.is_authenticated:
-        page = request.args.get('page', 1, type=int)
         per_page = current_app.config['MOMENTS_PHOTO_PER_PAGE']
-        stmt = (
-            select(Photo)
-            .join(Follow, Follow.followed_id == Photo.author_id)
-            .filter(Follow.follower_id == current_user.id)
-            .order_by(Photo.created_at.desc())
-        )
-        pagination = db.paginate(stmt, page=page, per_page=per_page)
+        stmt, sort_keys = Timeline.select_photos(current_user)
+        pagination = paginate(stmt, *sort_keys, per_page=per_page)
         photos = pagination.items
+        current_user.preload_relationships(photos=photos)
     else:
         pagination = None
         photos = None
-    stmt = (
-        select(Tag)
-        .join(Tag.photos)
-        .group_by(Tag.id)
-        .order_by(func.count(Photo.id).desc())
-        .limit(10)
+    tags = Tag.get_top_tags(10)
+    trending_tags = Tag.get_top_tags(10, trending=True)
+    add_cache_tags('tags')
+    return render_template(
+        'main/index.html', pagination=pagination, photos=photos, tags=tags, trending_tags=trending_tags
     )
-    tags = db.session.scalars(stmt).all()
-    return render_template('main/index.html', pagination=pagination, photos=photos, tags=tags)
 
 
 @main_bp.route('/explore')
 def explore():
-    stmt = select(Photo).order_by(func.random()).limit(12)
-    photos = db.session.scalars(stmt).all()
-    return render_template('main/explore.html', photos=photos)
+    order_rule = request.args.get('order_rule', 'random')
+    if order_rule == 'collections':
+        per_page = current_app.config['MOMENTS_PHOTO_PER_PAGE']
+        pagination = paginate(select(Photo), *Photo.get_sort_keys(order_rule), per_page=per_page)
+        photos = pagination.items
+    else:
+        pagination = None
+        photos = sample_rows(Photo, 12)
+    return render_template('main/explore.html', photos=photos, pagination=pagination, order_rule=order_rule)
 
 
 @main_bp.route('/search')
@@ -60,6 +73,7 @@ def search():
     # TODO: add SQLAlchemy 2.x support to Flask-Whooshee then update the following code
     if category == 'user':
         pagination = User.query.whooshee_search(q).paginate(page=page, per_page=per_page)
+        current_user.preload_relationships(users=pagination.items)
     elif category == 'tag':
         pagination = Tag.query.whooshee_search(q).paginate(page=page, per_page=per_page)
     else:
@@ -69,16 +83,16 @@ def search():
 
 
 @main_bp.route('/notifications')
+@primary_only
 @login_required
 def show_notifications():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_NOTIFICATION_PER_PAGE']
     stmt = current_user.notifications.select()
     filter_rule = request.args.get('filter')
     if filter_rule == 'unread':
         stmt = stmt.filter_by(is_read=False)
 
-    pagination = db.paginate(stmt.order_by(Notification.created_at.desc()), page=page, per_page=per_page)
+    pagination = paginate(stmt, Notification.created_at, Notification.id, per_page=per_page)
     notifications = pagination.items
     return render_template('main/notifications.html', pagination=pagination, notifications=notifications)
 
@@ -92,6 +106,7 @@ def read_notification(notification_id):
 
     notification.is_read = True
     db.session.commit()
+    publish_notifications_count(current_user)
     flash('Notification archived.', 'success')
     return redirect(url_for('.show_notifications'))
 
@@ -99,23 +114,42 @@ def read_notification(notification_id):
 @main_bp.route('/notifications/read/all', methods=['POST'])
 @login_required
 def read_all_notification():
-    stmt = current_user.notifications.select().filter_by(is_read=False)
-    notifications = db.session.scalars(stmt).all()
-    for notification in notifications:
-        notification.is_read = True
-    db.session.commit()
+    read_notifications(current_user)
+    publish_notifications_count(current_user)
     flash('All notifications archived.', 'success')
     return redirect(url_for('.show_notifications'))
 
 
+@main_bp.route('/notifications/delete/read', methods=['POST'])
+@login_required
+def delete_read_notification():
+    count = delete_notifications(current_user, is_read=True)
+    flash(f'{count} read notifications deleted.', 'success')
+    return redirect(url_for('.show_notifications'))
+
+
 @main_bp.route('/images/<path:filename>')
 def get_image(filename):
-    return send_from_directory(current_app.config['MOMENTS_UPLOAD_PATH'], filename)
+    upload_path = current_app.config['MOMENTS_UPLOAD_PATH']
+    accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality}
+    for image_format in current_app.config['MOMENTS_PHOTO_FORMATS']:
+        if f'image/{image_format}' not in accepted:
+            continue
+        alternative = Path(filename).with_suffix(f'.{image_format}').as_posix()
+        path = safe_join(str(upload_path), alternative)
+        if path is not None and os.path.isfile(path):
+            filename = alternative
+            break
+    response = send_image(upload_path, filename)
+    response.vary.add('Accept')
+    return response
 
 
 @main_bp.route('/avatars/<path:filename>')
 def get_avatar(filename):
-    return send_from_directory(current_app.config['AVATARS_SAVE_PATH'], filename)
+    # the identicons are named after the username, and drawn again in other colors when the
+    # username is changed or taken by a new account
+    return send_image(current_app.config['AVATARS_SAVE_PATH'], filename, immutable=is_unique_filename(filename))
 
 
 @main_bp.route('/upload', methods=['GET', 'POST'])
@@ -131,19 +165,27 @@ def upload():
             return 'Invalid image.', 400
         filename = rename_image(f.filename)
         f.save(current_app.config['MOMENTS_UPLOAD_PATH'] / filename)
-        filename_s = resize_image(f, filename, current_app.config['MOMENTS_PHOTO_SIZES']['small'])
-        filename_m = resize_image(f, filename, current_app.config['MOMENTS_PHOTO_SIZES']['medium'])
+        # serve the original until the resized variants are ready
         photo = Photo(
-            filename=filename, filename_s=filename_s, filename_m=filename_m, author=current_user._get_current_object()
+            filename=filename,
+            filename_s=filename,
+            filename_m=filename,
+            processing=True,
+            author=current_user._get_current_object(),
         )
         db.session.add(photo)
+        db.session.flush()
+        Timeline.push_photo(photo)
         db.session.commit()
+        process_photo(photo)
     return render_template('main/upload.html')
 
 
 @main_bp.route('/photo/<int:photo_id>')
+@cache_response
 def show_photo(photo_id):
     photo = db.session.get(Photo, photo_id) or abort(404)
+    add_cache_tags(f'photo:{photo.id}', f'user:{photo.author_id}')
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_COMMENT_PER_PAGE']
     pagination = db.paginate(
@@ -253,11 +295,11 @@ def report_photo(photo_id):
 @main_bp.route('/photo/<int:photo_id>/collectors')
 def show_collectors(photo_id):
     photo = db.session.get(Photo, photo_id) or abort(404)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_USER_PER_PAGE']
-    stmt = photo.collections.select().order_by(Collection.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = photo.collections.select()
+    pagination = paginate(stmt, Collection.created_at, Collection.user_id, per_page=per_page)
     collections = pagination.items
+    current_user.preload_relationships(users=[collection.user for collection in collections])
     return render_template('main/collectors.html', collections=collections, photo=photo, pagination=pagination)
 
 
@@ -314,15 +356,8 @@ def new_tag(photo_id):
 
     form = TagForm()
     if form.validate_on_submit():
-        for name in form.tag.data.split():
-            tag = db.session.scalar(select(Tag).filter_by(name=name))
-            if tag is None:
-                tag = Tag(name=name)
-                db.session.add(tag)
-                db.session.commit()
-            if tag not in photo.tags:
-                photo.tags.append(tag)
-                db.session.commit()
+        photo.add_tags(form.tag.data.split())
+        db.session.commit()
         flash('Tag added.', 'success')
 
     flash_errors(form)
@@ -395,17 +430,15 @@ def delete_comment(comment_id):
 
 
 @main_bp.route('/tag/<int:tag_id>')
+@cache_response
 def show_tag(tag_id):
     tag = db.session.get(Tag, tag_id) or abort(404)
-    page = request.args.get('page', 1, type=int)
+    add_cache_tags(f'tag:{tag.id}')
     order_rule = request.args.get('order_rule', 'time')
     per_page = current_app.config['MOMENTS_PHOTO_PER_PAGE']
-    stmt = tag.photos.select().order_by(Photo.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = tag.photos.select()
+    pagination = paginate(stmt, *Photo.get_sort_keys(order_rule), per_page=per_page)
     photos = pagination.items
-
-    if order_rule == 'collections':
-        photos.sort(key=lambda x: x.collectors_count, reverse=True)
     return render_template('main/tag.html', tag=tag, pagination=pagination, photos=photos, order_rule=order_rule)
 
 
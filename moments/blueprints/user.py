@@ -2,8 +2,9 @@ from flask import Blueprint, current_app, flash, redirect, render_template, requ
 from flask_login import current_user, fresh_login_required, login_required, logout_user
 from sqlalchemy import select
 
+from moments.cache import add_cache_tags, cache_response
 from moments.core.extensions import avatars, db
-from moments.decorators import confirm_required, permission_required
+from moments.decorators import confirm_required, permission_required, primary_only
 from moments.emails import send_change_email_email
 from moments.forms.user import (
     ChangeEmailForm,
@@ -17,6 +18,7 @@ from moments.forms.user import (
 )
 from moments.models import Collection, Follow, Photo, User
 from moments.notifications import push_follow_notification
+from moments.pagination import paginate
 from moments.settings import Operations
 from moments.utils import flash_errors, generate_token, parse_token, redirect_back
 
@@ -24,29 +26,32 @@ user_bp = Blueprint('user', __name__)
 
 
 @user_bp.route('/<username>')
+@cache_response
 def index(username):
     user = db.session.scalar(select(User).filter_by(username=username)) or abort(404)
+    add_cache_tags(f'user:{user.id}')
     if user == current_user and user.locked:
         flash('Your account is locked.', 'danger')
 
     if user == current_user and not user.active:
         logout_user()
 
-    page = request.args.get('page', 1, type=int)
+    order_rule = request.args.get('order_rule', 'time')
     per_page = current_app.config['MOMENTS_PHOTO_PER_PAGE']
-    stmt = user.photos.select().order_by(Photo.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = user.photos.select()
+    pagination = paginate(stmt, *Photo.get_sort_keys(order_rule), per_page=per_page)
     photos = pagination.items
-    return render_template('user/index.html', user=user, pagination=pagination, photos=photos)
+    return render_template('user/index.html', user=user, pagination=pagination, photos=photos, order_rule=order_rule)
 
 
 @user_bp.route('/<username>/collections')
+@cache_response
 def show_collections(username):
     user = db.session.scalar(select(User).filter_by(username=username)) or abort(404)
-    page = request.args.get('page', 1, type=int)
+    add_cache_tags(f'user:{user.id}')
     per_page = current_app.config['MOMENTS_PHOTO_PER_PAGE']
-    stmt = user.collections.select().order_by(Collection.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = user.collections.select()
+    pagination = paginate(stmt, Collection.created_at, Collection.photo_id, per_page=per_page)
     collections = pagination.items
     return render_template('user/collections.html', user=user, pagination=pagination, collections=collections)
 
@@ -81,28 +86,33 @@ def unfollow(username):
 
 
 @user_bp.route('/<username>/followers')
+@cache_response
 def show_followers(username):
     user = db.session.scalar(select(User).filter_by(username=username)) or abort(404)
-    page = request.args.get('page', 1, type=int)
+    add_cache_tags(f'user:{user.id}')
     per_page = current_app.config['MOMENTS_USER_PER_PAGE']
-    stmt = user.followers.select().order_by(Follow.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = user.followers.select()
+    pagination = paginate(stmt, Follow.created_at, Follow.follower_id, per_page=per_page)
     follows = pagination.items
+    current_user.preload_relationships(users=[follow.follower for follow in follows])
     return render_template('user/followers.html', user=user, pagination=pagination, follows=follows)
 
 
 @user_bp.route('/<username>/following')
+@cache_response
 def show_following(username):
     user = db.session.scalar(select(User).filter_by(username=username)) or abort(404)
-    page = request.args.get('page', 1, type=int)
+    add_cache_tags(f'user:{user.id}')
     per_page = current_app.config['MOMENTS_USER_PER_PAGE']
-    stmt = user.following.select().order_by(Follow.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = user.following.select()
+    pagination = paginate(stmt, Follow.created_at, Follow.followed_id, per_page=per_page)
     follows = pagination.items
+    current_user.preload_relationships(users=[follow.followed for follow in follows])
     return render_template('user/following.html', user=user, pagination=pagination, follows=follows)
 
 
 @user_bp.route('/settings/profile', methods=['GET', 'POST'])
+@primary_only
 @login_required
 def edit_profile():
     form = EditProfileForm()
@@ -125,6 +135,7 @@ def edit_profile():
 
 
 @user_bp.route('/settings/avatar')
+@primary_only
 @login_required
 @confirm_required
 def change_avatar():
@@ -211,6 +222,7 @@ def change_email(token):
 
 
 @user_bp.route('/settings/notification', methods=['GET', 'POST'])
+@primary_only
 @login_required
 def notification_setting():
     form = NotificationSettingForm()
@@ -228,6 +240,7 @@ def notification_setting():
 
 
 @user_bp.route('/settings/privacy', methods=['GET', 'POST'])
+@primary_only
 @login_required
 def privacy_setting():
     form = PrivacySettingForm()
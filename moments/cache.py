@@ -0,0 +1,360 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from itertools import chain
+from pathlib import Path
+
+from flask import current_app, g, has_app_context, make_response, request, session
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from moments.core.extensions import db
+from moments.models import Collection, Comment, Follow, Photo, Tag
+
+# rendered in place of the CSRF token, each visitor gets their own token when served
+CSRF_PLACEHOLDER = '__moments_csrf_token__'
+# the keys of the tag versions, the shared stores never evict them to make room
+VERSION_PREFIX = 'version:'
+# the tables whose rows are read by the cached pages and fragments, only their tags are versioned
+CACHED_TABLES = {'photo', 'tag', 'user'}
+# the query string arguments read by the cached views, the other ones skip the cache
+CACHED_ARGS = {'cursor', 'order_rule', 'page'}
+
+
+class LRUStore:
+    """In-process store keeping the `maxsize` most recently used entries."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, None if ttl is None else time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class FileSystemStore:
+    """Shared store keeping one pickle file per key, for the processes of one host.
+
+    `purge` deletes the expired files and the ones beyond `maxsize`, the earliest to expire
+    first.
+    """
+
+    def __init__(self, path, maxsize=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.maxsize = maxsize
+
+    def _get_path(self, key):
+        prefix = 'version-' if key.startswith(VERSION_PREFIX) else ''
+        return self.path / (prefix + hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                value, expires = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((value, expires), f)
+        os.replace(tmp_path, self._get_path(key))  # readers never see a partial file
+
+    def purge(self):
+        now = time.time()
+        entries = []
+        for path in self.path.iterdir():
+            try:
+                with open(path, 'rb') as f:
+                    _, expires = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+            if expires is not None and expires < now:
+                path.unlink(missing_ok=True)
+            elif not path.name.startswith('version-'):
+                entries.append((float('inf') if expires is None else expires, path))
+        if self.maxsize is not None and len(entries) > self.maxsize:
+            for _, path in sorted(entries)[: len(entries) - self.maxsize]:
+                path.unlink(missing_ok=True)
+
+
+class SQLiteStore:
+    """Shared store backed by a SQLite file, a stand-in for Redis on a single host.
+
+    `purge` deletes the expired rows and the ones beyond `maxsize`, the earliest to expire
+    first.
+    """
+
+    def __init__(self, path, maxsize=None):
+        self.maxsize = maxsize
+        self._connection = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                (key, pickle.dumps(value), expires),
+            )
+
+    def purge(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+            if self.maxsize is not None:
+                self._connection.execute(
+                    'DELETE FROM cache WHERE key IN (SELECT key FROM cache WHERE key NOT LIKE ? '
+                    'ORDER BY expires IS NULL DESC, expires DESC LIMIT -1 OFFSET ?)',
+                    (VERSION_PREFIX + '%', self.maxsize),
+                )
+
+
+class ResponseCache:
+    """Two-tier cache of rendered responses and template fragments, invalidated by tags
+    such as `photo:1`.
+
+    Every entry records the version of its tags when it was stored, `invalidate` gives the
+    tags a new version so the entries are treated as missing. The versions are kept in the
+    shared store, or in the process when there isn't one.
+
+    A version is kept for `version_ttl` seconds and no entry is cached for longer, so an
+    entry never outlives a version it has missed. The expired versions and entries are
+    purged every `purge_interval` seconds.
+    """
+
+    def __init__(self, maxsize, ttl, shared=None, version_ttl=60 * 60, purge_interval=5 * 60):
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self.purge_interval = purge_interval
+        self.local = LRUStore(maxsize)
+        self.shared = shared
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._next_purge = time.monotonic() + purge_interval
+
+    def get_version(self, tag):
+        if self.shared is None:
+            version, expires = self._versions.get(tag, (None, 0))
+            return version if expires >= time.time() else None
+        return self.shared.get(f'{VERSION_PREFIX}{tag}')
+
+    def invalidate(self, *tags):
+        expires = time.time() + self.version_ttl
+        for tag in tags:
+            version = uuid.uuid4().hex
+            if self.shared is None:
+                with self._lock:
+                    self._versions[tag] = (version, expires)
+            else:
+                self.shared.set(f'{VERSION_PREFIX}{tag}', version, ttl=self.version_ttl)
+        self.purge_if_due()
+
+    def purge_if_due(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_purge:
+                return
+            self._next_purge = now + self.purge_interval
+            if self.shared is None:
+                self._versions = {tag: item for tag, item in self._versions.items() if item[1] >= time.time()}
+        if self.shared is not None:
+            self.shared.purge()
+
+    def get(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry, ttl=entry['expires'] - time.time())
+        if entry is None:
+            return None
+        if any(self.get_version(tag) != version for tag, version in entry['tags'].items()):
+            return None
+        return entry['value']
+
+    def set(self, key, value, tags, ttl=None):
+        ttl = min(self.ttl if ttl is None else ttl, self.version_ttl)
+        entry = {
+            'value': value,
+            'tags': {tag: self.get_version(tag) for tag in tags},
+            'expires': time.time() + ttl,
+        }
+        self.local.set(key, entry, ttl=ttl)
+        if self.shared is not None:
+            self.shared.set(key, entry, ttl=ttl)
+        self.purge_if_due()
+
+
+def get_response_cache(app):
+    cache = app.extensions.get('moments_response_cache')
+    if cache is None:
+        backend = app.config['MOMENTS_RESPONSE_CACHE_BACKEND']
+        path = Path(app.config['MOMENTS_RESPONSE_CACHE_PATH'])
+        shared_size = app.config['MOMENTS_RESPONSE_CACHE_SHARED_SIZE']
+        if backend == 'filesystem':
+            shared = FileSystemStore(path, maxsize=shared_size)
+        elif backend == 'sqlite':
+            path.parent.mkdir(parents=True, exist_ok=True)
+            shared = SQLiteStore(path.with_suffix('.db'), maxsize=shared_size)
+        else:
+            shared = None
+        cache = ResponseCache(
+            app.config['MOMENTS_RESPONSE_CACHE_SIZE'],
+            app.config['MOMENTS_RESPONSE_CACHE_TTL'],
+            shared=shared,
+            version_ttl=app.config['MOMENTS_RESPONSE_CACHE_VERSION_TTL'],
+            purge_interval=app.config['MOMENTS_RESPONSE_CACHE_PURGE_INTERVAL'],
+        )
+        app.extensions['moments_response_cache'] = cache
+    return cache
+
+
+def add_cache_tags(*tags):
+    """Tag the response being cached, it is dropped when one of the tags is invalidated."""
+    if 'cache_tags' in g:
+        g.cache_tags.update(tags)
+
+
+def _insert_csrf_token(body):
+    if CSRF_PLACEHOLDER.encode() not in body:
+        return body
+    field_name = current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+    g.pop(field_name, None)
+    return body.replace(CSRF_PLACEHOLDER.encode(), generate_csrf().encode())
+
+
+def cache_response(func):
+    """Cache the page for anonymous visitors, keyed by the endpoint and its arguments."""
+
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        if (
+            not current_app.config['MOMENTS_RESPONSE_CACHE']
+            or current_user.is_authenticated
+            or request.method != 'GET'
+            or '_flashes' in session  # the page would show and consume the messages
+            or not request.args.keys() <= CACHED_ARGS  # made up arguments would each add an entry
+        ):
+            return func(*args, **kwargs)
+
+        cache = get_response_cache(current_app)
+        args_key = sorted(request.args.items(multi=True))
+        key = f'response:{request.endpoint}:{sorted(request.view_args.items())}:{args_key}:anonymous'
+        entry = cache.get(key)
+        if entry is not None:
+            response = current_app.response_class(_insert_csrf_token(entry['body']), status=entry['status'])
+            response.headers.update(entry['headers'])
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        g.cache_tags = set()
+        setattr(g, current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), CSRF_PLACEHOLDER)
+        response = make_response(func(*args, **kwargs))
+        tags = g.pop('cache_tags')
+        if response.status_code == 200 and not response.is_streamed and '_flashes' not in session:
+            entry = {
+                'status': response.status_code,
+                'headers': [
+                    (name, value)
+                    for name, value in response.headers.items()
+                    if name not in ('Set-Cookie', 'Content-Length')  # the length changes with the CSRF token
+                ],
+                'body': response.get_data(),
+            }
+            cache.set(key, entry, tags)
+        response.set_data(_insert_csrf_token(response.get_data()))
+        response.headers['X-Cache'] = 'MISS'
+        return response
+
+    return decorated_function
+
+
+def _get_cache_tags(obj):
+    if isinstance(obj, Photo):
+        history = inspect(obj).attrs.tags.history
+        return {f'user:{obj.author_id}', *[f'tag:{tag.id}' for tag in chain(*history)]}
+    if isinstance(obj, Comment):
+        return {f'photo:{obj.photo_id}'}
+    if isinstance(obj, Collection):
+        return {f'photo:{obj.photo_id}', f'user:{obj.user_id}'}
+    if isinstance(obj, Follow):
+        return {f'user:{obj.follower_id}', f'user:{obj.followed_id}'}
+    if isinstance(obj, Tag):
+        return {'tags'}
+    return set()
+
+
+# every inserted, updated or deleted row of the `CACHED_TABLES` gives its own tag such as
+# `photo:1`, the rows depending on it are added by `_get_cache_tags`
+@event.listens_for(db.Model, 'after_insert', propagate=True)
+@event.listens_for(db.Model, 'after_update', propagate=True)
+@event.listens_for(db.Model, 'after_delete', propagate=True)
+def collect_row_cache_tag(mapper, connection, target):
+    session = object_session(target)
+    if session is not None and mapper.local_table.name in CACHED_TABLES:
+        session.info.setdefault('cache_tags', set()).add(f'{mapper.local_table.name}:{target.id}')
+
+
+# collect the tags of the changed rows, they are invalidated once the transaction is committed
+@event.listens_for(Session, 'after_flush', named=True)
+def collect_cache_tags(**kwargs):
+    session = kwargs['session']
+    tags = session.info.setdefault('cache_tags', set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        tags.update(_get_cache_tags(obj))
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_cache_tags(session):
+    tags = session.info.pop('cache_tags', None)
+    if not tags or not has_app_context():
+        return
+    if current_app.config['MOMENTS_RESPONSE_CACHE'] or current_app.config['MOMENTS_FRAGMENT_CACHE']:
+        get_response_cache(current_app).invalidate(*tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_cache_tags(session):
+    session.info.pop('cache_tags', None)
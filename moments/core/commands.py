@@ -1,7 +1,58 @@
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
 import click
+from sqlalchemy import delete, insert, select
 
 from moments.core.extensions import db
-from moments.models import Role
+from moments.models import Follow, Photo, Role, Tag, Timeline, User, get_recount_statements
+
+
+def benchmark_sqlite(path, pragmas, seconds, readers):
+    """Run one writer and `readers` reader threads against a SQLite file, return the
+    number of reads and writes done in `seconds`.
+    """
+
+    def connect():
+        connection = sqlite3.connect(path)
+        for name, value in pragmas.items():
+            connection.execute(f'PRAGMA {name}={value}')
+        return connection
+
+    connection = connect()
+    connection.execute('CREATE TABLE item (id INTEGER PRIMARY KEY, body TEXT)')
+    connection.executemany('INSERT INTO item (body) VALUES (?)', [('x' * 200,)] * 1000)
+    connection.commit()
+    connection.close()
+
+    counts = {'read': 0, 'write': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def work(kind):
+        connection = connect()
+        done = 0
+        while time.monotonic() < deadline:
+            if kind == 'write':
+                connection.execute('INSERT INTO item (body) VALUES (?)', ('x' * 200,))
+                connection.commit()
+            else:
+                connection.execute('SELECT id, body FROM item ORDER BY id DESC LIMIT 20').fetchall()
+            done += 1
+        connection.close()
+        with lock:
+            counts[kind] += done
+
+    threads = [threading.Thread(target=work, args=('write',))]
+    threads += [threading.Thread(target=work, args=('read',)) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts['read'], counts['write']
 
 
 def register_commands(app):
@@ -25,6 +76,44 @@ def register_commands(app):
         Role.init_role()
         click.echo('Initialized the roles and permissions.')
 
+    @app.cli.command('recount')
+    def recount_command():
+        """Recalculate the counter columns of users, photos and tags."""
+        for stmt in get_recount_statements():
+            db.session.execute(stmt.execution_options(synchronize_session=False))
+        db.session.commit()
+        click.echo('Recounted the statistics.')
+
+    @app.cli.command('refresh-trending')
+    def refresh_trending_command():
+        """Recalculate the trending tags, run it periodically (e.g. hourly from cron)."""
+        Tag.refresh_trending(app.config['MOMENTS_TRENDING_DAYS'])
+        click.echo('Refreshed the trending tags.')
+
+    @app.cli.command('benchmark-sqlite')
+    @click.option('--seconds', default=5, help='Duration of each run.')
+    @click.option('--readers', default=4, help='Number of reader threads.')
+    def benchmark_sqlite_command(seconds, readers):
+        """Compare concurrent SQLite throughput with and without MOMENTS_SQLITE_PRAGMAS."""
+        with tempfile.TemporaryDirectory() as directory:
+            for label, pragmas in [('default', {}), ('tuned', app.config['MOMENTS_SQLITE_PRAGMAS'])]:
+                reads, writes = benchmark_sqlite(Path(directory) / f'{label}.db', pragmas, seconds, readers)
+                click.echo(f'{label}: {reads / seconds:.0f} reads/s, {writes / seconds:.0f} writes/s')
+
+    @app.cli.command('rebuild-timeline')
+    def rebuild_timeline_command():
+        """Rebuild the home timeline of every user."""
+        db.session.execute(delete(Timeline))
+        stmt = (
+            select(Follow.follower_id, Photo.id, Photo.created_at)
+            .join(Photo, Photo.author_id == Follow.followed_id)
+            .join(User, User.id == Follow.followed_id)
+            .filter(User.followers_count <= app.config['MOMENTS_TIMELINE_FANOUT_LIMIT'])
+        )
+        db.session.execute(insert(Timeline).from_select(['user_id', 'photo_id', 'created_at'], stmt))
+        db.session.commit()
+        click.echo('Rebuilt the timelines.')
+
     @app.cli.command('lorem')
     @click.option('--user', default=10, help='Quantity of users, default is 10.')
     @click.option('--follow', default=30, help='Quantity of follows, default is 30.')
@@ -55,4 +144,5 @@ def register_commands(app):
         click.echo(f'Generated {collect} collects.')
         fake_comment(comment)
         click.echo(f'Generated {comment} comments.')
+        Tag.refresh_trending(app.config['MOMENTS_TRENDING_DAYS'])
         click.echo('Done.')
@@ -1,9 +1,13 @@
+import random
+
+from flask import current_app, g, has_request_context, request
 from flask_avatars import Avatars
 from flask_bootstrap import Bootstrap5
 from flask_dropzone import Dropzone
 from flask_login import AnonymousUserMixin, LoginManager
 from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_whooshee import Whooshee
 from flask_wtf import CSRFProtect
 from sqlalchemy import MetaData
@@ -22,8 +26,38 @@ class Base(DeclarativeBase):
     )
 
 
+class RoutingSession(Session):
+    """Send the SELECTs of GET requests to one of the `MOMENTS_REPLICA_BINDS`.
+
+    Writes, the reads following a write in the same request and the views decorated with
+    `primary_only` use the primary database. After a write the client gets a cookie pinning
+    its next requests to the primary for `MOMENTS_REPLICA_PIN_SECONDS`, so the page it is
+    redirected to shows the change.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            replica_bind = self.get_replica_bind(clause)
+            if replica_bind is not None:
+                return db.engines[replica_bind]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def get_replica_bind(self, clause):
+        if not has_request_context() or not current_app.config['MOMENTS_REPLICA_BINDS']:
+            return None
+        if self._flushing or getattr(clause, 'is_dml', False):
+            g.use_primary = True  # read your own writes for the rest of the request
+            g.primary_write = True
+            return None
+        if request.method not in ('GET', 'HEAD') or g.get('use_primary') or not getattr(clause, 'is_select', False):
+            return None
+        if 'replica_bind' not in g:  # stick to one replica in a request
+            g.replica_bind = random.choice(current_app.config['MOMENTS_REPLICA_BINDS'])
+        return g.replica_bind
+
+
 bootstrap = Bootstrap5()
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 mail = Mail()
 dropzone = Dropzone()
@@ -53,6 +87,9 @@ class Guest(AnonymousUserMixin):
     def can(self, permission_name):
         return False
 
+    def preload_relationships(self, photos=(), users=()):
+        pass
+
     @property
     def is_admin(self):
         return False
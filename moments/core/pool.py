@@ -0,0 +1,96 @@
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy.pool import QueuePool
+
+from moments.core.extensions import db
+
+
+class PoolStats:
+    def __init__(self):
+        self.connects = 0
+        self.closes = 0
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def record_checkout(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def record_close(self):
+        with self._lock:
+            self.closes += 1
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A `QueuePool` counting the checkouts, the time spent waiting for a connection and
+    the connections opened and closed (the churn).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats  # keep counting after `engine.dispose()`
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        record = super()._do_get()
+        wait = time.perf_counter() - start
+        self.stats.record_checkout(wait)
+        if has_app_context() and wait >= current_app.config['MOMENTS_POOL_WAIT_WARNING']:
+            current_app.logger.warning(f'Waited {wait:f}s for a database connection: {self.get_stats()}')
+        return record
+
+    def _create_connection(self):
+        self.stats.record_connect()
+        return super()._create_connection()
+
+    def _close_connection(self, connection, *args, **kwargs):
+        self.stats.record_close()
+        return super()._close_connection(connection, *args, **kwargs)
+
+    def get_stats(self):
+        stats = self.stats
+        return {
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'checked_in': self.checkedin(),
+            'overflow': self.overflow(),
+            'checkouts': stats.checkouts,
+            'connects': stats.connects,
+            'closes': stats.closes,
+            'wait_avg_ms': stats.wait_total / stats.checkouts * 1000 if stats.checkouts else 0,
+            'wait_max_ms': stats.wait_max * 1000,
+        }
+
+
+def init_pool(app):
+    """Use the instrumented pool for the engines configured with a pool size, must be
+    called before `db.init_app`.
+    """
+    # a copy, the config dict is shared with the config class and every app made from it
+    options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    if options.get('pool_size') is not None:
+        options.setdefault('poolclass', InstrumentedQueuePool)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def get_pool_stats():
+    stats = {}
+    for bind_key, engine in db.engines.items():
+        pool = engine.pool
+        stats[bind_key or 'default'] = pool.get_stats() if hasattr(pool, 'get_stats') else {'status': pool.status()}
+    return stats
@@ -1,12 +1,73 @@
+import re
+from collections import Counter
+
+from flask import g, request
 from flask_sqlalchemy.record_queries import get_recorded_queries
 
+from moments.core.extensions import db
+
+PRIMARY_COOKIE = 'moments_primary'
+
 
 def register_request_handlers(app):
+    @app.before_request
+    def reset_request_globals():
+        # `g` outlives the request when the app context was pushed manually (e.g. in tests)
+        g.pop('relationship_cache', None)
+        g.pop('use_primary', None)
+        g.pop('primary_write', None)
+        g.pop('replica_bind', None)
+        g.pop('_sqlalchemy_queries', None)  # where Flask-SQLAlchemy records the queries
+        if request.cookies.get(PRIMARY_COOKIE):  # set after a recent write of this client
+            g.use_primary = True
+
+    # the after_request functions run in reverse order: the unit-of-work commit runs first,
+    # then the primary is pinned if it wrote, and the profiler records all the queries
     @app.after_request
     def query_profiler(response):
-        for q in get_recorded_queries():
+        queries = get_recorded_queries()
+        for q in queries:
             if q.duration >= app.config['MOMENTS_SLOW_QUERY_THRESHOLD']:
                 app.logger.warning(
                     'Slow query: Duration: ' f'{q.duration:f}s\n Context: {q.context}\nQuery: {q.statement}\n'
                 )
+        if not queries:
+            return response
+
+        duration = sum(q.duration for q in queries) * 1000
+        # the statements use placeholders, so the repeated ones only differ by their parameters
+        fingerprints = Counter(re.sub(r'\s+', ' ', q.statement).strip() for q in queries)
+        duplicates = {statement: count for statement, count in fingerprints.most_common() if count > 1}
+        stats = {
+            'endpoint': request.endpoint,
+            'query_count': len(queries),
+            'query_time_ms': round(duration, 2),
+            'duplicate_queries': sum(count - 1 for count in duplicates.values()),
+        }
+        app.logger.info(' '.join(f'{key}={value}' for key, value in stats.items()), extra={'query_stats': stats})
+        response.headers.add('Server-Timing', f'db;dur={duration:.2f};desc="{len(queries)} queries"')
+
+        if len(queries) > app.config['MOMENTS_QUERY_BUDGET']:
+            repeated = '\n'.join(f'{count}x {statement}' for statement, count in list(duplicates.items())[:3])
+            app.logger.warning(
+                f'Query budget exceeded: {request.endpoint} ran {len(queries)} queries '
+                f'(budget {app.config["MOMENTS_QUERY_BUDGET"]}).\nMost repeated:\n{repeated}'
+            )
+        return response
+
+    @app.after_request
+    def pin_primary(response):
+        if g.pop('primary_write', False):
+            max_age = app.config['MOMENTS_REPLICA_PIN_SECONDS']
+            response.set_cookie(PRIMARY_COOKIE, '1', max_age=max_age, httponly=True, samesite='Lax')
+        return response
+
+    @app.after_request
+    def commit_session(response):
+        # the changes staged by the model helpers in unit-of-work mode, see `moments.models.commit`
+        if g.pop('commit_pending', False):
+            if response.status_code < 400:
+                db.session.commit()
+            else:
+                db.session.rollback()
         return response
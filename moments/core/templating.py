@@ -1,17 +1,83 @@
+import threading
+from collections import Counter
+
+from flask import current_app
 from flask_login import current_user
-from sqlalchemy import func, select
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
 
+from moments.cache import get_response_cache
 from moments.core.extensions import db
-from moments.models import Notification
+
+
+class FragmentCacheExtension(Extension):
+    """Cache the rendered block, `{% cache key, ttl %}...{% endcache %}`.
+
+    The key is a name, or a list of a name followed by strings and the models shown in
+    the block. A model adds its tag such as `user:1` to the entry, so the block is rendered
+    again once the row is changed. The ttl defaults to `MOMENTS_FRAGMENT_CACHE_TTL`.
+
+    The tag versions live in the process without `MOMENTS_RESPONSE_CACHE_BACKEND`, so with
+    several workers the others keep serving the old block until it expires.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        self.hits = Counter()
+        self.misses = Counter()
+        self._stats_lock = threading.Lock()
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    def _render(self, key, ttl, caller):
+        if not current_app.config['MOMENTS_FRAGMENT_CACHE']:
+            return caller()
+
+        name, *parts = key if isinstance(key, (list, tuple)) else [key]
+        tags = [f'{part.__table__.name}:{part.id}' for part in parts if isinstance(part, db.Model)]
+        key_parts = [f'{part.__table__.name}:{part.id}' if isinstance(part, db.Model) else str(part) for part in parts]
+        cache_key = ':'.join(['fragment', name, *key_parts])
+
+        cache = get_response_cache(current_app)
+        value = cache.get(cache_key)
+        if value is not None:
+            with self._stats_lock:
+                self.hits[name] += 1
+            return Markup(value)
+        with self._stats_lock:
+            self.misses[name] += 1
+        value = caller()
+        cache.set(cache_key, str(value), tags, ttl=ttl or current_app.config['MOMENTS_FRAGMENT_CACHE_TTL'])
+        return value
+
+    def get_stats(self):
+        stats = {}
+        with self._stats_lock:
+            counts = {name: (self.hits[name], self.misses[name]) for name in self.hits.keys() | self.misses.keys()}
+        for name, (hits, misses) in sorted(counts.items()):
+            stats[name] = {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses)}
+        return stats
+
+
+def get_fragment_cache_stats(app):
+    return app.jinja_env.extensions[FragmentCacheExtension.identifier].get_stats()
 
 
 def register_template_handlers(app):
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
     @app.context_processor
     def make_template_context():
-        if current_user.is_authenticated:
-            notification_count = db.session.scalar(
-                select(func.count(Notification.id)).filter_by(receiver_id=current_user.id, is_read=False)
-            )
-        else:
-            notification_count = None
+        notification_count = current_user.unread_notifications if current_user.is_authenticated else None
         return dict(notification_count=notification_count)
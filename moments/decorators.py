@@ -1,6 +1,6 @@
 from functools import wraps
 
-from flask import abort, flash, redirect, url_for
+from flask import abort, flash, g, redirect, url_for
 from flask_login import current_user
 from markupsafe import Markup
 
@@ -34,3 +34,15 @@ def permission_required(permission_name):
 
 def admin_required(func):
     return permission_required('ADMIN')(func)
+
+
+def primary_only(func):
+    """Read from the primary database, for pages showing what the user just changed.
+
+    Put it above `login_required`, so the current user is loaded from the primary too.
+    """
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        g.use_primary = True
+        return func(*args, **kwargs)
+    return decorated_function
@@ -8,7 +8,8 @@ from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError
 
 from moments.core.extensions import db
-from moments.models import Comment, Notification, Photo, Tag, User
+from moments.models import Comment, Notification, Photo, Tag, Timeline, User
+from moments.sampling import sample_rows
 
 fake = Faker()
 
@@ -51,9 +52,9 @@ def fake_user(count=10):
 
 def fake_follow(count=30):
     for _ in range(count):
-        user = db.session.scalar(select(User).order_by(func.random()).limit(1))
-        user2 = db.session.scalar(select(User).order_by(func.random()).limit(1))
-        user.follow(user2)
+        users = sample_rows(User, 2)
+        if len(users) == 2:
+            users[0].follow(users[1])
     db.session.commit()
 
 
@@ -90,13 +91,11 @@ def fake_photo(count=30):
             created_at=fake.date_time_this_year(),
         )
         db.session.add(photo)
+        db.session.flush()
 
         # tags
-        for _ in range(random.randint(1, 5)):
-            tag_count = db.session.scalar(select(func.count(Tag.id)))
-            tag = db.session.get(Tag, random.randint(1, tag_count))
-            if tag not in photo.tags:
-                photo.tags.append(tag)
+        photo.add_tags(tag.name for tag in sample_rows(Tag, random.randint(1, 5)))
+        Timeline.push_photo(photo)
     db.session.commit()
 
 
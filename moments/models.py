@@ -1,11 +1,35 @@
-from datetime import datetime, timezone
+import glob
+import mimetypes
+from collections import defaultdict
+from itertools import chain
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
 from typing import Optional
 
-from flask import current_app
+from flask import current_app, g, has_app_context, has_request_context, url_for
 from flask_avatars import Identicon
 from flask_login import UserMixin
-from sqlalchemy import Column, ForeignKey, String, Text, event, func, select, engine
-from sqlalchemy.orm import Mapped, WriteOnlyMapped, mapped_column, relationship
+from sqlalchemy import (
+    JSON,
+    Column,
+    ForeignKey,
+    Index,
+    String,
+    Text,
+    delete,
+    engine,
+    event,
+    func,
+    insert,
+    inspect,
+    literal,
+    or_,
+    select,
+    true,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Mapped, Session, WriteOnlyMapped, mapped_column, relationship
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from moments.core.extensions import db, whooshee
@@ -34,6 +58,28 @@ class Permission(db.Model):
         return f'Permission {self.id}: {self.name}'
 
 
+def commit():
+    """Commit the session, or leave it to the end of the request in unit-of-work mode.
+
+    With `MOMENTS_UNIT_OF_WORK` enabled, the model helpers only stage their changes and
+    `moments.core.request` commits them once after the view, unless the view commits first.
+    """
+    if has_request_context() and current_app.config['MOMENTS_UNIT_OF_WORK']:
+        g.commit_pending = True
+    else:
+        db.session.commit()
+
+
+def insert_ignore(table):
+    """Return an INSERT of `table` skipping the rows that conflict with existing ones."""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return insert(table).prefix_with('IGNORE')  # MySQL
+
+
 class Role(db.Model):
     __tablename__ = 'role'
 
@@ -68,7 +114,32 @@ class Role(db.Model):
                     permission = Permission(name=permission_name)
                     db.session.add(permission)
                 role.permissions.append(permission)
-        db.session.commit()
+        commit()
+        Role.clear_permission_cache()
+
+    @staticmethod
+    def get_permission_map():
+        """Return the immutable role id -> permission names map, loaded once per process.
+
+        A committed role change drops the map of this process only, the other worker
+        processes keep theirs until they are restarted, e.g. after `flask init`.
+        """
+        permission_map = current_app.extensions.get('moments_role_permissions')
+        if permission_map is None:
+            permissions = {}
+            for role_id, permission_name in db.session.execute(
+                select(Role.id, Permission.name).outerjoin(Role.permissions)
+            ):
+                names = permissions.setdefault(role_id, set())
+                if permission_name is not None:  # roles without permissions
+                    names.add(permission_name)
+            permission_map = MappingProxyType({role_id: frozenset(names) for role_id, names in permissions.items()})
+            current_app.extensions['moments_role_permissions'] = permission_map
+        return permission_map
+
+    @staticmethod
+    def clear_permission_cache():
+        current_app.extensions.pop('moments_role_permissions', None)
 
     def __repr__(self):
         return f'Role {self.id}: {self.name}'
@@ -102,6 +173,91 @@ class Collection(db.Model):
         return f'Collect: user_id={self.user_id}, photo_id={self.photo_id}'
 
 
+class Timeline(db.Model):
+    __tablename__ = 'timeline'
+    __table_args__ = (Index('ix_timeline_user_id_created_at', 'user_id', 'created_at'),)
+
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    photo_id: Mapped[int] = mapped_column(ForeignKey('photo.id', ondelete='CASCADE'), primary_key=True)
+    created_at: Mapped[datetime]  # copied from the photo, used to sort the timeline
+
+    @staticmethod
+    def is_pulled(author):
+        # photos of authors with too many followers are read from the photo table instead
+        return author.followers_count > current_app.config['MOMENTS_TIMELINE_FANOUT_LIMIT']
+
+    @staticmethod
+    def push_photo(photo):
+        if Timeline.is_pulled(photo.author):
+            return
+        stmt = select(Follow.follower_id, literal(photo.id), literal(photo.created_at)).filter(
+            Follow.followed_id == photo.author_id
+        )
+        db.session.execute(insert(Timeline).from_select(['user_id', 'photo_id', 'created_at'], stmt))
+
+    @staticmethod
+    def backfill(user, followed):
+        if Timeline.is_pulled(followed):
+            return
+        stmt = (
+            select(literal(user.id), Photo.id, Photo.created_at)
+            .filter(Photo.author_id == followed.id)
+            .order_by(Photo.created_at.desc())
+            .limit(current_app.config['MOMENTS_TIMELINE_BACKFILL_LIMIT'])
+        )
+        db.session.execute(insert(Timeline).from_select(['user_id', 'photo_id', 'created_at'], stmt))
+
+    @staticmethod
+    def push_author(author_id):
+        """Push the recent photos of an author who is no longer pulled to the followers'
+        timelines, the photos posted while the author was pulled were never pushed.
+        """
+        photos = (
+            select(Photo.id, Photo.created_at)
+            .filter(Photo.author_id == author_id)
+            .order_by(Photo.created_at.desc())
+            .limit(current_app.config['MOMENTS_TIMELINE_BACKFILL_LIMIT'])
+            .subquery()
+        )
+        pushed = select(Timeline.photo_id).filter(
+            Timeline.user_id == Follow.follower_id, Timeline.photo_id == photos.c.id
+        )
+        # every follower gets every photo
+        stmt = (
+            select(Follow.follower_id, photos.c.id, photos.c.created_at)
+            .select_from(Follow)
+            .join(photos, true())
+            .filter(Follow.followed_id == author_id, ~pushed.exists())
+        )
+        db.session.execute(insert(Timeline).from_select(['user_id', 'photo_id', 'created_at'], stmt))
+
+    @staticmethod
+    def prune(user, followed):
+        photo_ids = select(Photo.id).filter(Photo.author_id == followed.id)
+        db.session.execute(delete(Timeline).filter(Timeline.user_id == user.id, Timeline.photo_id.in_(photo_ids)))
+
+    @staticmethod
+    def select_photos(user):
+        """Return the statement of the user's home photos and the columns to sort it by."""
+        pulled_author_ids = db.session.scalars(
+            select(Follow.followed_id)
+            .join(User, User.id == Follow.followed_id)
+            .filter(
+                Follow.follower_id == user.id,
+                User.followers_count > current_app.config['MOMENTS_TIMELINE_FANOUT_LIMIT'],
+            )
+        ).all()
+        if not pulled_author_ids:
+            stmt = select(Photo).join(Timeline, Timeline.photo_id == Photo.id).filter(Timeline.user_id == user.id)
+            return stmt, (Timeline.created_at, Photo.id)
+        pushed_photo_ids = select(Timeline.photo_id).filter(Timeline.user_id == user.id)
+        stmt = select(Photo).filter(or_(Photo.id.in_(pushed_photo_ids), Photo.author_id.in_(pulled_author_ids)))
+        return stmt, (Photo.created_at, Photo.id)
+
+    def __repr__(self):
+        return f'Timeline: user_id={self.user_id}, photo_id={self.photo_id}'
+
+
 @whooshee.register_model('name', 'username')
 class User(db.Model, UserMixin):
     __tablename__ = 'user'
@@ -126,6 +282,10 @@ class User(db.Model, UserMixin):
     receive_comment_notification: Mapped[bool] = mapped_column(default=True)
     receive_follow_notification: Mapped[bool] = mapped_column(default=True)
     receive_collect_notification: Mapped[bool] = mapped_column(default=True)
+    followers_count: Mapped[int] = mapped_column(default=0)
+    following_count: Mapped[int] = mapped_column(default=0)
+    photos_count: Mapped[int] = mapped_column(default=0)
+    unread_notifications: Mapped[int] = mapped_column(default=0)
 
     role_id: Mapped[Optional[int]] = mapped_column(ForeignKey('role.id'))
 
@@ -166,7 +326,7 @@ class User(db.Model, UserMixin):
         if self.role is None:
             role_name = 'Administrator' if self.email == admin_email else 'User'
             self.role = db.session.scalar(select(Role).filter_by(name=role_name))
-            db.session.commit()
+            commit()
 
     def validate_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -175,64 +335,107 @@ class User(db.Model, UserMixin):
         if not self.is_following(user):
             follow = Follow(follower=self, followed=user)
             db.session.add(follow)
-            db.session.commit()
+            if self.id is not None and user.id is not None:
+                Timeline.backfill(self, user)
+            commit()
+            self._cache_relationship('following', user.id, True)
+            user._cache_relationship('followed_by', self.id, True)
 
     def unfollow(self, user):
         follow = db.session.scalar(self.following.select().filter_by(followed_id=user.id))
         if follow:
             db.session.delete(follow)
-            db.session.commit()
+            Timeline.prune(self, user)
+            commit()
+        self._cache_relationship('following', user.id, False)
+        user._cache_relationship('followed_by', self.id, False)
 
     def is_following(self, user):
         if user.id is None:  # user.id will be None when follow self
             return False
-        follow = db.session.scalar(self.following.select().filter_by(followed_id=user.id))
-        return follow is not None
+        stmt = self.following.select().filter_by(followed_id=user.id)
+        return self._check_relationship('following', user.id, stmt)
 
     def is_followed_by(self, user):
-        follow = db.session.scalar(self.followers.select().filter_by(follower_id=user.id))
-        return follow is not None
+        stmt = self.followers.select().filter_by(follower_id=user.id)
+        return self._check_relationship('followed_by', user.id, stmt)
 
     def collect(self, photo):
         if not self.is_collecting(photo):
             collection = Collection(user=self, photo=photo)
             db.session.add(collection)
-            db.session.commit()
+            commit()
+            self._cache_relationship('collecting', photo.id, True)
 
     def uncollect(self, photo):
         collection = db.session.scalar(self.collections.select().filter_by(photo_id=photo.id))
         if collection:
             db.session.delete(collection)
-            db.session.commit()
+            commit()
+        self._cache_relationship('collecting', photo.id, False)
 
     def is_collecting(self, photo):
-        collection = db.session.scalar(self.collections.select().filter_by(photo_id=photo.id))
-        return collection is not None
+        stmt = self.collections.select().filter_by(photo_id=photo.id)
+        return self._check_relationship('collecting', photo.id, stmt)
+
+    def preload_relationships(self, photos=(), users=()):
+        """Load the relationships between this user and the given photos and users with one
+        query per relationship, so the `is_*` methods can answer from the cache afterwards.
+        """
+        photo_ids = {photo.id for photo in photos}
+        user_ids = {user.id for user in users if user.id != self.id}
+        if photo_ids:
+            stmt = select(Collection.photo_id).filter(Collection.user_id == self.id, Collection.photo_id.in_(photo_ids))
+            self._fill_relationship_cache('collecting', photo_ids, db.session.scalars(stmt))
+        if user_ids:
+            stmt = select(Follow.followed_id).filter(Follow.follower_id == self.id, Follow.followed_id.in_(user_ids))
+            self._fill_relationship_cache('following', user_ids, db.session.scalars(stmt))
+            stmt = select(Follow.follower_id).filter(Follow.followed_id == self.id, Follow.follower_id.in_(user_ids))
+            self._fill_relationship_cache('followed_by', user_ids, db.session.scalars(stmt))
+
+    def _relationship_cache(self, name):
+        # the cache lives in `g`, so it only lasts for the current request
+        return g.setdefault('relationship_cache', {}).setdefault((self.id, name), {})
+
+    def _check_relationship(self, name, target_id, stmt):
+        cache = self._relationship_cache(name)
+        if target_id not in cache:
+            cache[target_id] = db.session.scalar(stmt) is not None
+        return cache[target_id]
+
+    def _cache_relationship(self, name, target_id, value):
+        if self.id is not None and target_id is not None:
+            self._relationship_cache(name)[target_id] = value
+
+    def _fill_relationship_cache(self, name, target_ids, matched_ids):
+        cache = self._relationship_cache(name)
+        cache.update(dict.fromkeys(target_ids, False))
+        cache.update(dict.fromkeys(matched_ids, True))
 
     def lock(self):
         self.locked = True
         locked_role = db.session.scalar(select(Role).filter_by(name='Locked'))
         self.role = locked_role
-        db.session.commit()
+        commit()
 
     def unlock(self):
         self.locked = False
         user_role = db.session.scalar(select(Role).filter_by(name='User'))
         self.role = user_role
-        db.session.commit()
+        commit()
 
     def block(self):
         self.active = False
-        db.session.commit()
+        commit()
 
     def unblock(self):
         self.active = True
-        db.session.commit()
+        commit()
 
     def generate_avatar(self):
         avatar = Identicon()
         self.avatar_s, self.avatar_m, self.avatar_l = avatar.generate(text=self.username)
-        db.session.commit()
+        commit()
 
     @property
     def is_admin(self):
@@ -243,31 +446,12 @@ class User(db.Model, UserMixin):
         return self.active
 
     def can(self, permission_name):
-        permission = db.session.scalar(select(Permission).filter_by(name=permission_name))
-        return permission is not None and self.role is not None and permission in self.role.permissions
-
-    @property
-    def followers_count(self):
-        stmt = self.followers.select().with_only_columns(func.count())
-        return db.session.scalar(stmt) - 1  # minus user self
-
-    @property
-    def following_count(self):
-        stmt = self.following.select().with_only_columns(func.count())
-        return db.session.scalar(stmt) - 1  # minus user self
-
-    @property
-    def photos_count(self):
-        return db.session.scalar(select(func.count(Photo.id)).filter_by(author_id=self.id))
+        return permission_name in Role.get_permission_map().get(self.role_id, ())
 
     @property
     def collections_count(self):
         return db.session.scalar(select(func.count(Collection.user_id)).filter_by(photo_id=self.id))
 
-    @property
-    def notifications_count(self):
-        return db.session.scalar(select(func.count(Notification.id)).filter_by(receiver_id=self.id, is_read=False))
-
     def __repr__(self):
         return f'User {self.id}: {self.username}'
 
@@ -282,6 +466,7 @@ photo_tag = db.Table(
 @whooshee.register_model('description')
 class Photo(db.Model):
     __tablename__ = 'photo'
+    __table_args__ = (Index('ix_photo_author_id_collectors_count', 'author_id', 'collectors_count'),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     description: Mapped[Optional[str]] = mapped_column(String(500))
@@ -291,6 +476,9 @@ class Photo(db.Model):
     created_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(timezone.utc), index=True)
     can_comment: Mapped[bool] = mapped_column(default=True)
     flag: Mapped[int] = mapped_column(default=0)
+    processing: Mapped[bool] = mapped_column(default=False)  # the resized variants are not ready yet
+    collectors_count: Mapped[int] = mapped_column(default=0, index=True)
+    comments_count: Mapped[int] = mapped_column(default=0)
 
     author_id: Mapped[int] = mapped_column(ForeignKey('user.id', ondelete='CASCADE'))
 
@@ -302,31 +490,130 @@ class Photo(db.Model):
         back_populates='photo', cascade='all, delete-orphan', passive_deletes=True
     )
     tags: Mapped[list['Tag']] = relationship(secondary=photo_tag, back_populates='photos', passive_deletes=True)
+    variants: Mapped[list['PhotoVariant']] = relationship(
+        back_populates='photo', cascade='all, delete-orphan', passive_deletes=True, lazy='selectin'
+    )
 
-    @property
-    def collectors_count(self):
-        return db.session.scalar(select(func.count(Collection.user_id)).filter_by(photo_id=self.id))
+    def srcset(self, mimetype=None):
+        """Return the `srcset` value of the variants in the given format, the original format by default."""
+        mimetype = mimetype or mimetypes.guess_type(self.filename)[0]
+        widths = {variant.filename: variant.width for variant in self.variants if variant.mimetype == mimetype}
+        return ', '.join(
+            f'{url_for("main.get_image", filename=filename)} {width}w'
+            for filename, width in sorted(widths.items(), key=lambda item: item[1])
+        )
+
+    def add_tags(self, names):
+        """Tag the photo with `names` in a constant number of statements and return the tags.
+
+        The links are inserted with Core, so the counters listener doesn't see them and the
+        tags' photos_count is updated here. The photo must have been flushed.
+        """
+        tags = Tag.get_or_create(names)
+        rows = [{'photo_id': self.id, 'tag_id': tag.id} for tag in tags]
+        if db.engine.dialect.insert_returning:
+            stmt = insert_ignore(photo_tag).returning(photo_tag.c.tag_id)
+            linked_ids = set(db.session.scalars(stmt, rows)) if rows else set()
+        else:
+            linked_ids = {row['tag_id'] for row in rows} - set(
+                db.session.scalars(select(photo_tag.c.tag_id).filter_by(photo_id=self.id))
+            )
+            if linked_ids:
+                db.session.execute(insert_ignore(photo_tag), [row for row in rows if row['tag_id'] in linked_ids])
+        if linked_ids:
+            db.session.execute(update(Tag).filter(Tag.id.in_(linked_ids)).values(photos_count=Tag.photos_count + 1))
+            db.session.expire(self, ['tags'])
+            cache_tags = db.session.info.setdefault('cache_tags', set())
+            cache_tags.update({f'photo:{self.id}', f'user:{self.author_id}', 'tags'})
+            cache_tags.update(f'tag:{tag_id}' for tag_id in linked_ids)
+        return tags
 
-    @property
-    def comments_count(self):
-        return db.session.scalar(select(func.count(Comment.id)).filter_by(photo_id=self.id))
+    @staticmethod
+    def get_sort_keys(order_rule):
+        """Return the columns to sort the photos by for the `order_rule` argument,
+        `collections` puts the most collected photos first.
+        """
+        if order_rule == 'collections':
+            return Photo.collectors_count, Photo.id
+        return Photo.created_at, Photo.id
 
     def __repr__(self):
         return f'Photo {self.id}: {self.filename}'
 
 
+class PhotoVariant(db.Model):
+    __tablename__ = 'photo_variant'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(20))  # key of MOMENTS_PHOTO_SIZES or 'original'
+    width: Mapped[int]
+    mimetype: Mapped[str] = mapped_column(String(30))
+    filename: Mapped[str] = mapped_column(String(64))
+
+    photo_id: Mapped[int] = mapped_column(ForeignKey('photo.id', ondelete='CASCADE'), index=True)
+
+    photo: Mapped['Photo'] = relationship(back_populates='variants')
+
+    def __repr__(self):
+        return f'PhotoVariant {self.id}: {self.filename}'
+
+
 @whooshee.register_model('name')
 class Tag(db.Model):
     __tablename__ = 'tag'
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(64), index=True, unique=True)
+    photos_count: Mapped[int] = mapped_column(default=0, index=True)
+    trending_count: Mapped[int] = mapped_column(default=0, index=True)  # set by `refresh_trending`
 
     photos: WriteOnlyMapped['Photo'] = relationship(secondary=photo_tag, back_populates='tags', passive_deletes=True)
 
-    @property
-    def photos_count(self):
-        return db.session.scalar(select(func.count(photo_tag.c.photo_id)).filter_by(tag_id=self.id))
+    @staticmethod
+    def get_or_create(names):
+        """Return the tags named `names`, the missing ones are created with one
+        `INSERT ... ON CONFLICT DO NOTHING` and all are loaded with one `SELECT ... IN`.
+        """
+        names = list(dict.fromkeys(names))
+        if not names:
+            return []
+        rows = [{'name': name} for name in names]
+        if db.engine.dialect.insert_returning:
+            created_ids = set(db.session.scalars(insert_ignore(Tag.__table__).returning(Tag.id), rows))
+        else:
+            db.session.execute(insert_ignore(Tag.__table__), rows)
+            created_ids = None
+        tags = {tag.name: tag for tag in db.session.scalars(select(Tag).filter(Tag.name.in_(names)))}
+        tags = [tags[name] for name in names]
+        # the rows were inserted with Core, they are indexed for the search once committed
+        created = {tag.id: tag.name for tag in tags if created_ids is None or tag.id in created_ids}
+        db.session.info.setdefault('created_tags', {}).update(created)
+        return tags
+
+    @staticmethod
+    def get_top_tags(limit, trending=False):
+        """Return the tags with the most photos, or with the most recent photos when
+        `trending`, read from the indexed counter columns.
+        """
+        column = Tag.trending_count if trending else Tag.photos_count
+        stmt = select(Tag).filter(column > 0).order_by(column.desc(), Tag.id.desc()).limit(limit)
+        return db.session.scalars(stmt).all()
+
+    @staticmethod
+    def refresh_trending(days):
+        """Count the photos of each tag created in the last `days` days, run it
+        periodically with `flask refresh-trending`.
+        """
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        count = (
+            select(func.count(photo_tag.c.photo_id))
+            .join(Photo, Photo.id == photo_tag.c.photo_id)
+            .where(photo_tag.c.tag_id == Tag.id, Photo.created_at >= since)
+            .scalar_subquery()
+        )
+        db.session.execute(update(Tag).values(trending_count=count).execution_options(synchronize_session=False))
+        db.session.info.setdefault('cache_tags', set()).add('tags')  # drop the cached sidebars
+        db.session.commit()
 
     def __repr__(self):
         return f'Tag {self.id}: {self.name}'
@@ -355,13 +642,27 @@ class Comment(db.Model):
         return f'Comment {self.id}: {self.body}'
 
 
+# the distinct users counted by a coalesced notification, only a sample is kept in `actors`
+notification_actor = db.Table(
+    'notification_actor',
+    Column('notification_id', ForeignKey('notification.id', ondelete='CASCADE'), primary_key=True),
+    Column('user_id', ForeignKey('user.id', ondelete='CASCADE'), primary_key=True),
+)
+
+
 class Notification(db.Model):
     __tablename__ = 'notification'
+    __table_args__ = (Index('ix_notification_receiver_id_kind_target_id', 'receiver_id', 'kind', 'target_id'),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     message: Mapped[str] = mapped_column(Text)
     is_read: Mapped[bool] = mapped_column(default=False)
     created_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(timezone.utc), index=True)
+    # similar events are coalesced into one notification, see `moments.notifications`
+    kind: Mapped[Optional[str]] = mapped_column(String(20))
+    target_id: Mapped[Optional[int]]
+    actor_count: Mapped[int] = mapped_column(default=1)  # distinct actors, or events without an actor
+    actors: Mapped[Optional[list]] = mapped_column(JSON)  # [username, URL] of the latest actors
 
     receiver_id: Mapped[int] = mapped_column(ForeignKey('user.id', ondelete='CASCADE'))
 
@@ -371,17 +672,97 @@ class Notification(db.Model):
         return f'Notification {self.id}: {self.message}'
 
 
-# enbale foreign key support for SQLite
+# roles are edited rarely, drop the cached role -> permissions map once the change is committed,
+# so the map is never reloaded from rows that are still rolled back
+@event.listens_for(Session, 'after_flush', named=True)
+def mark_permissions_changed(**kwargs):
+    session = kwargs['session']
+    models = (Role, Permission)
+    # a role is also dirty when it is given to a user, through the `users` backref
+    if any(isinstance(obj, models) for obj in (*session.new, *session.deleted)) or any(
+        isinstance(obj, models) and _has_permission_changes(obj) for obj in session.dirty
+    ):
+        session.info['permissions_changed'] = True
+
+
+def _has_permission_changes(obj):
+    attrs = inspect(obj).attrs
+    relationship_attr = attrs.permissions if isinstance(obj, Role) else attrs.roles
+    return attrs.name.history.has_changes() or relationship_attr.history.has_changes()
+
+
+@event.listens_for(Session, 'after_commit')
+def clear_permission_cache(session):
+    if session.info.pop('permissions_changed', False):
+        Role.clear_permission_cache()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_permissions_changed(session, previous_transaction):
+    if previous_transaction.parent is None:  # a rolled back savepoint leaves the outer changes
+        session.info.pop('permissions_changed', None)
+
+
+@event.listens_for(Session, 'after_commit')
+def clear_commit_pending(session):
+    if has_request_context():
+        g.pop('commit_pending', None)
+
+
+@event.listens_for(Session, 'after_commit')
+def index_created_tags(session):
+    """Index the tags created by `Tag.get_or_create` with one writer."""
+    created_tags = session.info.pop('created_tags', None)
+    if not created_tags:
+        return
+    config = current_app.extensions['whooshee']
+    if not config['enable_indexing']:
+        return
+    whoosheer = next(whoosheer for whoosheer in whooshee.whoosheers if Tag in whoosheer.models)
+    index = whooshee.get_or_create_index(current_app._get_current_object(), whoosheer)
+    with index.writer(timeout=config['writer_timeout']) as writer:
+        for tag_id, name in created_tags.items():
+            writer.update_document(id=tag_id, name=name)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_created_tags(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('created_tags', None)
+
+
+# enbale foreign key support and the `MOMENTS_SQLITE_PRAGMAS` profile for SQLite
 @event.listens_for(engine.Engine, 'connect')
 def set_sqlite_pragma(dbapi_connection, connection_record):
     import sqlite3
 
     if isinstance(dbapi_connection, sqlite3.Connection):
+        pragmas = current_app.config['MOMENTS_SQLITE_PRAGMAS'] if has_app_context() else {'foreign_keys': 'ON'}
         cursor = dbapi_connection.cursor()
-        cursor.execute('PRAGMA foreign_keys=ON')
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
         cursor.close()
 
 
+# the numeric values SQLite reports for the named pragma settings
+SQLITE_PRAGMA_VALUES = {'OFF': 0, 'ON': 1, 'NORMAL': 1, 'FULL': 2, 'EXTRA': 3, 'DEFAULT': 0, 'FILE': 1, 'MEMORY': 2}
+
+
+def check_sqlite_pragmas(app):
+    """Warn about the configured SQLite pragmas the database didn't take, e.g. WAL on
+    an in-memory database or an mmap size above the compile-time limit.
+    """
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite':
+            return
+        with db.engine.connect() as connection:
+            for name, value in app.config['MOMENTS_SQLITE_PRAGMAS'].items():
+                actual = str(connection.exec_driver_sql(f'PRAGMA {name}').scalar()).lower()
+                expected = {str(value).lower(), str(SQLITE_PRAGMA_VALUES.get(str(value).upper(), value))}
+                if actual not in expected:
+                    app.logger.warning(f'SQLite pragma {name} is {actual}, expected {value}.')
+
+
 @event.listens_for(User, 'after_delete', named=True)
 def delete_avatars(**kwargs):
     target = kwargs['target']
@@ -395,7 +776,169 @@ def delete_avatars(**kwargs):
 @event.listens_for(Photo, 'after_delete', named=True)
 def delete_photos(**kwargs):
     target = kwargs['target']
+    upload_path = current_app.config['MOMENTS_UPLOAD_PATH']
     for filename in [target.filename, target.filename_s, target.filename_m]:
-        path = current_app.config['MOMENTS_UPLOAD_PATH'] / filename
+        path = upload_path / filename
         if path.exists():  # not every filename map a unique file
             path.unlink()
+    for path in upload_path.glob(glob.escape(target.filename) + '_*'):  # the resized variants
+        path.unlink()
+
+
+def get_recount_statements(user_ids=None, photo_ids=None, tag_ids=None):
+    """Return the UPDATEs recalculating the counter columns from the rows they count,
+    for every row or only for the given ids.
+    """
+    statements = []
+    if user_ids is None or user_ids:
+        stmt = update(User).values(
+            followers_count=select(func.count())
+            .where(Follow.followed_id == User.id, Follow.follower_id != User.id)
+            .scalar_subquery(),
+            following_count=select(func.count())
+            .where(Follow.follower_id == User.id, Follow.followed_id != User.id)
+            .scalar_subquery(),
+            photos_count=select(func.count(Photo.id)).where(Photo.author_id == User.id).scalar_subquery(),
+            unread_notifications=select(func.count(Notification.id))
+            .where(Notification.receiver_id == User.id, Notification.is_read.is_(False))
+            .scalar_subquery(),
+        )
+        statements.append(stmt if user_ids is None else stmt.where(User.id.in_(user_ids)))
+    if photo_ids is None or photo_ids:
+        stmt = update(Photo).values(
+            collectors_count=select(func.count(Collection.user_id))
+            .where(Collection.photo_id == Photo.id)
+            .scalar_subquery(),
+            comments_count=select(func.count(Comment.id)).where(Comment.photo_id == Photo.id).scalar_subquery(),
+        )
+        statements.append(stmt if photo_ids is None else stmt.where(Photo.id.in_(photo_ids)))
+    if tag_ids is None or tag_ids:
+        stmt = update(Tag).values(
+            photos_count=select(func.count(photo_tag.c.photo_id)).where(photo_tag.c.tag_id == Tag.id).scalar_subquery()
+        )
+        statements.append(stmt if tag_ids is None else stmt.where(Tag.id.in_(tag_ids)))
+    return statements
+
+
+def _get_cascade_affected_ids(session):
+    # the rows counted elsewhere that the database removes along with the deleted ones
+    user_ids, photo_ids, tag_ids = set(), set(), set()
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            follows = session.execute(
+                select(Follow.follower_id, Follow.followed_id).filter(
+                    or_(Follow.follower_id == obj.id, Follow.followed_id == obj.id)
+                )
+            )
+            user_ids.update(chain.from_iterable(follows))
+            photo_ids.update(session.scalars(select(Collection.photo_id).filter_by(user_id=obj.id)))
+            photo_ids.update(session.scalars(select(Comment.photo_id).filter_by(author_id=obj.id)))
+            stmt = select(photo_tag.c.tag_id).join(Photo, Photo.id == photo_tag.c.photo_id)
+            tag_ids.update(session.scalars(stmt.filter(Photo.author_id == obj.id)))
+        elif isinstance(obj, Comment):
+            photo_ids.add(obj.photo_id)  # the replies are deleted too
+    deleted = {(type(obj), getattr(obj, 'id', None)) for obj in session.deleted}
+    return (
+        {user_id for user_id in user_ids if (User, user_id) not in deleted},
+        {photo_id for photo_id in photo_ids if (Photo, photo_id) not in deleted},
+        {tag_id for tag_id in tag_ids if (Tag, tag_id) not in deleted},
+    )
+
+
+def _get_pulled_author_ids(session):
+    # the pulled authors losing followers, they may have to be pushed again
+    author_ids = set()
+    for obj in session.deleted:
+        if isinstance(obj, Follow) and Timeline.is_pulled(obj.followed):
+            author_ids.add(obj.followed_id)
+        elif isinstance(obj, User):
+            stmt = (
+                select(Follow.followed_id)
+                .join(User, User.id == Follow.followed_id)
+                .filter(
+                    Follow.follower_id == obj.id,
+                    User.followers_count > current_app.config['MOMENTS_TIMELINE_FANOUT_LIMIT'],
+                )
+            )
+            author_ids.update(session.scalars(stmt))
+    return author_ids
+
+
+# keep the denormalized counter columns in step with the rows they count, the changes
+# are flushed in the same transaction as the rows themselves. The counters depending on
+# rows removed by database level cascades (e.g. deleting an account) are recalculated
+# once the flush is done.
+@event.listens_for(Session, 'before_flush', named=True)
+def update_counters(**kwargs):
+    session = kwargs['session']
+    deltas = defaultdict(int)
+    if session.deleted:
+        with session.no_autoflush:
+            session.info['recount_ids'] = _get_cascade_affected_ids(session)
+            if has_app_context():
+                session.info['pulled_author_ids'] = _get_pulled_author_ids(session)
+
+    for obj, delta in [(obj, 1) for obj in session.new] + [(obj, -1) for obj in session.deleted]:
+        if isinstance(obj, Follow) and obj.follower is not obj.followed:
+            deltas[obj.follower, 'following_count'] += delta
+            deltas[obj.followed, 'followers_count'] += delta
+        elif isinstance(obj, Collection):
+            deltas[obj.photo, 'collectors_count'] += delta
+        elif isinstance(obj, Comment):
+            deltas[obj.photo, 'comments_count'] += delta
+        elif isinstance(obj, Notification) and not obj.is_read:
+            deltas[obj.receiver, 'unread_notifications'] += delta
+        elif isinstance(obj, Photo):
+            deltas[obj.author, 'photos_count'] += delta
+            if delta < 0:
+                for tag in obj.tags:
+                    deltas[tag, 'photos_count'] -= 1
+
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Photo):
+            history = inspect(obj).attrs.tags.history
+            for tag in history.added:
+                deltas[tag, 'photos_count'] += 1
+            for tag in history.deleted:
+                deltas[tag, 'photos_count'] -= 1
+        elif isinstance(obj, Notification) and obj not in session.new:
+            history = inspect(obj).attrs.is_read.history
+            if history.added and history.deleted and bool(history.added[0]) != bool(history.deleted[0]):
+                deltas[obj.receiver, 'unread_notifications'] += -1 if obj.is_read else 1
+
+    for (obj, name), delta in deltas.items():
+        if obj is None or delta == 0 or obj in session.deleted:
+            continue
+        if inspect(obj).persistent:
+            # let the database do the arithmetic so concurrent updates are not lost
+            setattr(obj, name, getattr(type(obj), name) + delta)
+        else:
+            setattr(obj, name, (getattr(obj, name) or 0) + delta)
+
+
+@event.listens_for(Session, 'after_flush_postexec', named=True)
+def recount_cascaded_counters(**kwargs):
+    session = kwargs['session']
+    recount_ids = session.info.pop('recount_ids', None)
+    if recount_ids is None:
+        return
+    for stmt in get_recount_statements(*recount_ids):
+        session.execute(stmt.execution_options(synchronize_session=False))
+    for model, ids in zip((User, Photo, Tag), recount_ids):
+        for row_id in ids:
+            obj = session.identity_map.get(session.identity_key(model, row_id))
+            if obj is not None:
+                session.expire(obj)
+
+
+@event.listens_for(Session, 'after_flush_postexec', named=True)
+def push_unpulled_authors(**kwargs):
+    session = kwargs['session']
+    author_ids = session.info.pop('pulled_author_ids', None)
+    if not author_ids:
+        return
+    stmt = select(User.id).filter(
+        User.id.in_(author_ids), User.followers_count <= current_app.config['MOMENTS_TIMELINE_FANOUT_LIMIT']
+    )
+    for author_id in session.scalars(stmt).all():
+        Timeline.push_author(author_id)
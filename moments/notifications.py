@@ -1,35 +1,288 @@
-from flask import url_for
+import atexit
+import contextlib
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app, url_for
+from sqlalchemy import delete, func, select, update
 
 from moments.core.extensions import db
-from moments.models import Notification
+from moments.models import Notification, User, insert_ignore, notification_actor
+
+
+class NotificationHub:
+    """In-process publish/subscribe hub feeding the notification event streams.
+
+    Every open stream holds a queue of the events sent to its user. Events published in
+    one process are not seen by the others, the streams send the current count on each
+    (re)connect so a client is never far behind.
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        events = queue.Queue(maxsize=self.maxsize)
+        with self._lock:
+            self._subscribers[user_id].add(events)
+        return events
+
+    def unsubscribe(self, user_id, events):
+        with self._lock:
+            self._subscribers[user_id].discard(events)
+            if not self._subscribers[user_id]:
+                del self._subscribers[user_id]
+
+    def publish(self, user_id, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for events in subscribers:
+            # the client stopped reading, it will get the count on reconnect
+            with contextlib.suppress(queue.Full):
+                events.put_nowait((event, data))
+
+
+notification_hub = NotificationHub()
+
+
+def format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def publish_notifications_count(user):
+    notification_hub.publish(user.id, 'count', {'count': user.unread_notifications})
+
+
+def publish_notification(notification):
+    receiver = notification.receiver
+    data = {'id': notification.id, 'message': notification.message, 'count': receiver.unread_notifications}
+    notification_hub.publish(receiver.id, 'notification', data)
+
+
+def _filter_notifications(stmt, user, is_read=None, days=None):
+    stmt = stmt.filter_by(receiver_id=user.id)
+    if is_read is not None:
+        stmt = stmt.filter_by(is_read=is_read)
+    if days is not None:
+        stmt = stmt.filter(Notification.created_at < datetime.now(timezone.utc) - timedelta(days=days))
+    return stmt
+
+
+def read_notifications(user, days=None):
+    """Mark the unread notifications of `user` as read with one UPDATE and return the count.
+
+    Pass `days` to only archive the notifications older than that many days.
+    """
+    stmt = _filter_notifications(update(Notification), user, is_read=False, days=days)
+    stmt = stmt.values(is_read=True).execution_options(synchronize_session=False)
+    count = db.session.execute(stmt).rowcount
+    if count:
+        user.unread_notifications = User.unread_notifications - count
+    db.session.commit()
+    return count
+
+
+def delete_notifications(user, is_read=None, days=None):
+    """Delete the notifications of `user` with one DELETE and return the count.
+
+    The notifications can be limited to the read (or unread) ones and to the ones older
+    than `days` days.
+    """
+    unread = 0
+    if is_read is not True:
+        stmt = _filter_notifications(select(func.count(Notification.id)), user, is_read=False, days=days)
+        unread = db.session.scalar(stmt)
+    stmt = _filter_notifications(delete(Notification), user, is_read, days)
+    count = db.session.execute(stmt.execution_options(synchronize_session=False)).rowcount
+    if unread:
+        user.unread_notifications = User.unread_notifications - unread
+    db.session.commit()
+    return count
+
+
+def _render_actors(notification):
+    links = [f'<a href="{url}">{username}</a>' for username, url in notification.actors]
+    others = notification.actor_count - len(links)
+    if others > 0:
+        return f'{", ".join(links)} and {others} {"other" if others == 1 else "others"}'
+    if len(links) > 1:
+        return f'{", ".join(links[:-1])} and {links[-1]}'
+    return links[0]
+
+
+def _add_actor(notification, actor_id):
+    """Record the actor of a notification that may be coalesced, return whether it is new.
+
+    The notification is flushed first when it has no id yet.
+    """
+    if notification.id is None:
+        db.session.flush()
+    stmt = insert_ignore(notification_actor).values(notification_id=notification.id, user_id=actor_id)
+    return db.session.execute(stmt).rowcount > 0
+
+
+def _write_notification(receiver_id, kind, render, target_id=None, actor=None):
+    """Add a notification, or fold it into the unread one of the same kind and target.
+
+    Events within `MOMENTS_NOTIFICATION_COALESCE_WINDOW` seconds update the existing row
+    in place, it keeps the number of distinct actors and the latest few (username, URL)
+    pairs. `actor` is a (user id, username, URL) tuple. The caller commits the session.
+    """
+    window = current_app.config['MOMENTS_NOTIFICATION_COALESCE_WINDOW']
+    now = datetime.now(timezone.utc)
+    notification = None
+    if window:
+        stmt = (
+            select(Notification)
+            .filter_by(receiver_id=receiver_id, kind=kind, target_id=target_id, is_read=False)
+            .filter(Notification.created_at >= now - timedelta(seconds=window))
+            .order_by(Notification.created_at.desc())
+            .limit(1)
+        )
+        notification = db.session.scalar(stmt)
+    created = notification is None
+    if created:
+        receiver = db.session.get(User, receiver_id)
+        notification = Notification(receiver=receiver, kind=kind, target_id=target_id, actor_count=0, actors=[])
+        db.session.add(notification)
+
+    if actor is None:
+        notification.actor_count += 1
+    else:
+        actor_id, username, url = actor
+        # the sample also covers the rows coalesced before their actors were recorded
+        sampled = username in [name for name, _ in notification.actors]
+        if created or (_add_actor(notification, actor_id) and not sampled):
+            notification.actor_count += 1
+            sample_size = current_app.config['MOMENTS_NOTIFICATION_SAMPLE_ACTORS']
+            notification.actors = [[username, url], *notification.actors][:sample_size]
+    notification.created_at = now
+    notification.message = render(notification)
+    if created and actor is not None and window:
+        _add_actor(notification, actor[0])
+    return notification
+
+
+class NotificationWriter:
+    """Write the notifications from a background thread, in one transaction per batch.
+
+    A batch is written when `MOMENTS_NOTIFICATION_BATCH_SIZE` events are buffered or
+    `MOMENTS_NOTIFICATION_FLUSH_INTERVAL` milliseconds after its first event, the buffer
+    is flushed when the process exits. A batch that fails is written again one event at
+    a time, so a bad event only drops itself.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['MOMENTS_NOTIFICATION_FLUSH_INTERVAL'] / 1000
+        self.batch_size = app.config['MOMENTS_NOTIFICATION_BATCH_SIZE']
+        self._events = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='notification-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, event):
+        self._events.put(event)
+
+    def close(self, timeout=10):
+        if self._thread.is_alive():
+            self._events.put(None)
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            batch = [event]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    event = self._events.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if event is None:
+                    self._write(batch)
+                    return
+                batch.append(event)
+            self._write(batch)
+
+    def _write(self, batch):
+        if not self._write_batch(batch) and len(batch) > 1:
+            for event in batch:
+                self._write_batch([event])
+
+    def _write_batch(self, batch):
+        with self.app.app_context():
+            try:
+                notifications = [_write_notification(*event) for event in batch]
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception(f'Failed to write {len(batch)} notifications.')
+                return False
+            for notification in notifications:
+                publish_notification(notification)
+            return True
+
+
+def get_notification_writer(app):
+    writer = app.extensions.get('moments_notification_writer')
+    if writer is None:
+        writer = NotificationWriter(app)
+        app.extensions['moments_notification_writer'] = writer
+    return writer
+
+
+def _push_notification(receiver, kind, render, target_id=None, actor=None):
+    """Send the notification to the background writer, or write it now in synchronous mode."""
+    app = current_app._get_current_object()
+    event = (receiver.id, kind, render, target_id, actor)
+    if app.config['MOMENTS_NOTIFICATION_ASYNC']:
+        get_notification_writer(app).put(event)
+        return
+    notification = _write_notification(*event)
+    db.session.commit()
+    publish_notification(notification)
 
 
 def push_follow_notification(follower, receiver):
     if not receiver.receive_follow_notification:
         return
-    user_url = url_for('user.index', username=follower.username)
-    message = f'User <a href="{user_url}">{follower.username}</a> followed you.'
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+
+    def render(notification):
+        return f'User {_render_actors(notification)} followed you.'
+
+    actor = (follower.id, follower.username, url_for('user.index', username=follower.username))
+    _push_notification(receiver, 'follow', render, actor=actor)
 
 
 def push_comment_notification(photo_id, receiver, page=1):
     if not receiver.receive_comment_notification:
         return
     photo_url = url_for('main.show_photo', photo_id=photo_id, page=page)
-    message = f'<a href="{photo_url}#comments">This photo</a> has new comment/reply.'
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+
+    def render(notification):
+        if notification.actor_count > 1:
+            return f'<a href="{photo_url}#comments">This photo</a> has {notification.actor_count} new comments/replies.'
+        return f'<a href="{photo_url}#comments">This photo</a> has new comment/reply.'
+
+    _push_notification(receiver, 'comment', render, target_id=photo_id)
 
 
 def push_collect_notification(user, photo_id, receiver):
     if not receiver.receive_collect_notification:
         return
-    user_url = url_for('user.index', username=user.username)
     photo_url = url_for('main.show_photo', photo_id=photo_id)
-    message = f'User <a href="{user_url}">{user.username}</a> collected your <a href="{photo_url}">photo</a>'
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+
+    def render(notification):
+        return f'User {_render_actors(notification)} collected your <a href="{photo_url}">photo</a>'
+
+    actor = (user.id, user.username, url_for('user.index', username=user.username))
+    _push_notification(receiver, 'collect', render, target_id=photo_id, actor=actor)
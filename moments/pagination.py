@@ -0,0 +1,117 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import abort, current_app, request, url_for
+from sqlalchemy import DateTime, and_, or_
+
+from moments.core.extensions import db
+
+
+class CursorPagination:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def next_url(self):
+        return self._url_for(self.next_cursor)
+
+    @property
+    def prev_url(self):
+        return self._url_for(self.prev_cursor)
+
+    @staticmethod
+    def _url_for(cursor):
+        if cursor is None:
+            return None
+        args = request.args.to_dict()
+        args.update(request.view_args, cursor=cursor)
+        return url_for(request.endpoint, **args)
+
+
+def encode_cursor(direction, values):
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    payload = json.dumps([direction, *values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def _decode_value(key, value):
+    if isinstance(key.type, DateTime):
+        return datetime.fromisoformat(value)
+    python_type = key.type.python_type
+    # compare the exact type, `true` would pass an isinstance check for int
+    if type(value) is not python_type:
+        raise ValueError
+    return value
+
+
+def decode_cursor(cursor, keys):
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, *values = json.loads(payload)
+        if direction not in ('next', 'prev') or len(values) != len(keys):
+            raise ValueError
+        return direction, [_decode_value(key, value) for key, value in zip(keys, values)]
+    except (binascii.Error, TypeError, ValueError):
+        abort(400, description='Invalid page cursor.')
+
+
+def _after(keys, values, descending):
+    # (a, b) < (x, y)  =>  a < x OR (a = x AND b < y)
+    clauses = []
+    for i, key in enumerate(keys):
+        compare = key < values[i] if descending else key > values[i]
+        clauses.append(and_(*[k == v for k, v in zip(keys[:i], values[:i])], compare))
+    return or_(*clauses)
+
+
+def paginate(stmt, *keys, per_page, descending=True, **kwargs):
+    """Paginate `stmt` ordered by `keys`, the last key must be unique.
+
+    By default the rows after the `cursor` argument are selected with a keyset condition,
+    so no OFFSET or COUNT(*) is needed. Set `MOMENTS_PAGINATION_MODE` to `page` to use the
+    page number based `db.paginate` instead, extra keyword arguments are passed to it.
+    """
+    if current_app.config['MOMENTS_PAGINATION_MODE'] == 'page':
+        ordering = [key.desc() if descending else key.asc() for key in keys]
+        page = request.args.get('page', 1, type=int)
+        return db.paginate(stmt.order_by(None).order_by(*ordering), page=page, per_page=per_page, **kwargs)
+
+    direction, values = 'next', None
+    cursor = request.args.get('cursor')
+    if cursor:
+        direction, values = decode_cursor(cursor, keys)
+    backwards = direction == 'prev'
+    reverse = descending != backwards
+    stmt = stmt.order_by(None).order_by(*[key.desc() if reverse else key.asc() for key in keys])
+    if values is not None:
+        stmt = stmt.filter(_after(keys, values, reverse))
+
+    items = db.session.scalars(stmt.limit(per_page + 1)).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+    if not items:
+        return CursorPagination(items)
+
+    has_next = has_more if not backwards else True
+    has_prev = has_more if backwards else values is not None
+    first = [getattr(items[0], key.key) for key in keys]
+    last = [getattr(items[-1], key.key) for key in keys]
+    return CursorPagination(
+        items,
+        next_cursor=encode_cursor('next', last) if has_next else None,
+        prev_cursor=encode_cursor('prev', first) if has_prev else None,
+    )
@@ -0,0 +1,40 @@
+import random
+
+from sqlalchemy import func, select
+
+from moments.core.extensions import db
+
+
+def sample_rows(model, count, max_attempts=3):
+    """Pick up to `count` random rows of `model` without sorting the whole table.
+
+    Random ids are drawn from the primary key range and fetched with one `IN` lookup,
+    ids of deleted rows simply don't match, so the draw is retried a few times before
+    the rest is filled with the rows following a random id.
+    """
+    min_id, max_id = db.session.execute(select(func.min(model.id), func.max(model.id))).one()
+    if min_id is None:
+        return []
+
+    id_range = range(min_id, max_id + 1)
+    rows = {}
+    for _ in range(max_attempts):
+        needed = count - len(rows)
+        if needed <= 0:
+            break
+        candidates = set(random.sample(id_range, min(needed * 2, len(id_range)))) - rows.keys()
+        for row in db.session.scalars(select(model).filter(model.id.in_(candidates))):
+            rows[row.id] = row
+        if len(rows) >= count or len(rows) == len(id_range):
+            break
+
+    start = random.choice(id_range)
+    for condition in (model.id >= start, model.id < start):
+        needed = count - len(rows)
+        if needed <= 0:
+            break
+        stmt = select(model).filter(condition, model.id.notin_(list(rows))).order_by(model.id).limit(needed)
+        for row in db.session.scalars(stmt):
+            rows[row.id] = row
+
+    return random.sample(list(rows.values()), min(count, len(rows)))
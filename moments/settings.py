@@ -17,6 +17,7 @@ class BaseConfig:
     MOMENTS_ADMIN_EMAIL = os.getenv('MOMENTS_ADMIN', 'admin@helloflask.com')
     MOMENTS_ERROR_EMAIL_SUBJECT = '[Greybook] Application Error'
     MOMENTS_LOGGING_PATH = os.getenv('MOMENTS_LOGGING_PATH', BASE_DIR / 'logs/moments.log')
+    MOMENTS_PAGINATION_MODE = 'cursor'  # 'cursor' or 'page'
     MOMENTS_PHOTO_PER_PAGE = 12
     MOMENTS_COMMENT_PER_PAGE = 15
     MOMENTS_NOTIFICATION_PER_PAGE = 20
@@ -26,13 +27,48 @@ class BaseConfig:
     MOMENTS_MANAGE_TAG_PER_PAGE = 50
     MOMENTS_MANAGE_COMMENT_PER_PAGE = 30
     MOMENTS_SEARCH_RESULT_PER_PAGE = 20
+    MOMENTS_TIMELINE_FANOUT_LIMIT = 10000  # authors with more followers are pulled instead of pushed
+    MOMENTS_TIMELINE_BACKFILL_LIMIT = 200
     MOMENTS_MAIL_SUBJECT_PREFIX = '[Moments]'
     MOMENTS_UPLOAD_PATH = os.getenv('MOMENTS_UPLOAD_PATH', BASE_DIR / 'uploads')
-    MOMENTS_PHOTO_SIZES = {'small': 400, 'medium': 800}
+    MOMENTS_PHOTO_SIZES = {'small': 400, 'medium': 800}  # extra widths can be added, e.g. 'large': 1600
     MOMENTS_PHOTO_SUFFIXES = {
         MOMENTS_PHOTO_SIZES['small']: '_s',  # thumbnail
         MOMENTS_PHOTO_SIZES['medium']: '_m',  # display
     }
+    MOMENTS_PHOTO_FORMATS = ['avif', 'webp']  # extra formats of each size, in order of preference
+    MOMENTS_IMAGE_WORKERS = 2  # 0 to resize the photos in the request
+    MOMENTS_NOTIFICATION_COALESCE_WINDOW = 24 * 60 * 60  # seconds, 0 to disable
+    MOMENTS_NOTIFICATION_SAMPLE_ACTORS = 3
+    MOMENTS_NOTIFICATION_ASYNC = True  # write the notifications from a background thread
+    MOMENTS_NOTIFICATION_FLUSH_INTERVAL = 200  # milliseconds
+    MOMENTS_NOTIFICATION_BATCH_SIZE = 100
+    # push the notifications with Server-Sent Events instead of polling the count, each open stream
+    # holds a worker, so it needs a single process with async workers, e.g. `gunicorn -k gevent -w 1`
+    MOMENTS_NOTIFICATION_STREAM = os.getenv('MOMENTS_NOTIFICATION_STREAM') == 'true'
+    MOMENTS_NOTIFICATION_KEEPALIVE = 15  # seconds
+    MOMENTS_NOTIFICATION_STREAM_TIMEOUT = 300
+    MOMENTS_TRENDING_DAYS = 7  # the window counted by `flask refresh-trending`
+    MOMENTS_REPLICA_BINDS = []  # keys of SQLALCHEMY_BINDS used for the reads of GET requests
+    MOMENTS_REPLICA_PIN_SECONDS = 5  # read from the primary after a write, longer than the replication lag
+    MOMENTS_RESPONSE_CACHE_BACKEND = os.getenv('MOMENTS_RESPONSE_CACHE_BACKEND')  # 'filesystem', 'sqlite' or None
+    # cache the pages of anonymous visitors. The changes only reach the other processes through
+    # a shared backend, so it is off without one
+    MOMENTS_RESPONSE_CACHE = MOMENTS_RESPONSE_CACHE_BACKEND is not None
+    MOMENTS_RESPONSE_CACHE_SIZE = 1000  # entries kept in each process
+    MOMENTS_RESPONSE_CACHE_SHARED_SIZE = 10000  # entries kept in the shared backend, besides the tag versions
+    MOMENTS_RESPONSE_CACHE_TTL = 60  # seconds
+    MOMENTS_RESPONSE_CACHE_VERSION_TTL = 60 * 60  # seconds, also the longest an entry is cached
+    MOMENTS_RESPONSE_CACHE_PURGE_INTERVAL = 5 * 60  # seconds between the purges of the expired entries
+    MOMENTS_RESPONSE_CACHE_PATH = BASE_DIR / 'cache'
+    # cache the blocks wrapped in {% cache %}, kept with the responses, off without a shared backend too
+    MOMENTS_FRAGMENT_CACHE = MOMENTS_RESPONSE_CACHE_BACKEND is not None
+    MOMENTS_FRAGMENT_CACHE_TTL = 300  # seconds
+    MOMENTS_UNIT_OF_WORK = True  # commit the changes of the model helpers once per request
+    MOMENTS_IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+    MOMENTS_MUTABLE_IMAGE_MAX_AGE = 60  # seconds, for the identicons named after the username
+    MOMENTS_IMAGE_SENDFILE = os.getenv('MOMENTS_IMAGE_SENDFILE')  # 'x-sendfile', 'x-accel-redirect' or None
+    MOMENTS_IMAGE_ACCEL_PREFIX = '/_uploads/'  # internal proxy location mapped to MOMENTS_UPLOAD_PATH
 
     SECRET_KEY = os.getenv('SECRET_KEY', 'secret string')
     MAX_CONTENT_LENGTH = 3 * 1024 * 1024  # file size exceed to 3 Mb will return a 413 error response.
@@ -40,6 +76,23 @@ class BaseConfig:
     BOOTSTRAP_SERVE_LOCAL = True
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('DATABASE_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DATABASE_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.getenv('DATABASE_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DATABASE_POOL_RECYCLE', 1800)),  # seconds
+        'pool_pre_ping': True,
+    }
+    MOMENTS_POOL_WAIT_WARNING = 0.1  # seconds
+    MOMENTS_SQLITE_PRAGMAS = {
+        'foreign_keys': 'ON',
+        'journal_mode': 'WAL',  # readers don't wait for the writer
+        'synchronous': 'NORMAL',  # safe with WAL, commits skip the fsync
+        'busy_timeout': 5000,  # milliseconds
+        'cache_size': -16000,  # negative values are in KiB
+        'mmap_size': 128 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    }
 
     AVATARS_SAVE_PATH = MOMENTS_UPLOAD_PATH / 'avatars'
     AVATARS_SIZE_TUPLE = (30, 100, 200)
@@ -59,6 +112,8 @@ class BaseConfig:
 
     WHOOSHEE_MIN_STRING_LEN = 1
     MOMENTS_SLOW_QUERY_THRESHOLD = 1
+    MOMENTS_QUERY_BUDGET = 30  # queries per request, more are logged as a warning
+    SQLALCHEMY_RECORD_QUERIES = True
 
 
 class DevelopmentConfig(BaseConfig):
@@ -68,12 +123,24 @@ class DevelopmentConfig(BaseConfig):
 
 class TestingConfig(BaseConfig):
     TESTING = True
+    MOMENTS_IMAGE_WORKERS = 0
+    MOMENTS_NOTIFICATION_ASYNC = False
+    MOMENTS_NOTIFICATION_STREAM = True
+    MOMENTS_RESPONSE_CACHE = False
+    MOMENTS_FRAGMENT_CACHE = False
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///'  # in-memory database
+    MOMENTS_SQLITE_PRAGMAS = {'foreign_keys': 'ON'}
+    SQLALCHEMY_ENGINE_OPTIONS = {}  # the in-memory database uses a static pool
 
 
 class ProductionConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', SQLITE_PREFIX + str(BASE_DIR / 'data.db'))
+    MOMENTS_SQLITE_PRAGMAS = {**BaseConfig.MOMENTS_SQLITE_PRAGMAS, 'cache_size': -64000, 'mmap_size': 512 * 1024 * 1024}
+    SQLALCHEMY_BINDS = {
+        f'replica{i}': url for i, url in enumerate(os.getenv('DATABASE_REPLICA_URLS', '').split(), start=1)
+    }
+    MOMENTS_REPLICA_BINDS = list(SQLALCHEMY_BINDS)
 
 
 config = {
@@ -94,24 +94,48 @@ document.addEventListener('DOMContentLoaded', () => {
       .catch(handleFetchError);
   }
 
-  function updateNotificationsCount() {
+  function renderNotificationsCount(count) {
     const elem = document.getElementById('notification-badge');
-    if (!elem) {
-      return;
+    if (count === 0) {
+      elem.style.display = 'none';
+    } else {
+      elem.style.display = 'block';
+      elem.textContent = count;
     }
+  }
+
+  function updateNotificationsCount() {
+    const elem = document.getElementById('notification-badge');
     fetch(elem.dataset.href)
       .then(response => response.json())
-      .then(data => {
-        if (data.count === 0) {
-          elem.style.display = 'none';
-        } else {
-          elem.style.display = 'block';
-          elem.textContent = data.count;
-        }
-      })
+      .then(data => renderNotificationsCount(data.count))
       .catch(handleFetchError);
   }
 
+  function listenNotifications() {
+    const elem = document.getElementById('notification-badge');
+    if (!elem) {
+      return;
+    }
+    if (!elem.dataset.streamHref || !window.EventSource) {
+      setInterval(updateNotificationsCount, 30000);
+      return;
+    }
+    // the browser reconnects by itself when the server ends the stream
+    const source = new EventSource(elem.dataset.streamHref);
+    source.addEventListener('error', () => {
+      if (source.readyState === EventSource.CLOSED) {  // the stream is refused, poll instead
+        setInterval(updateNotificationsCount, 30000);
+      }
+    });
+    source.addEventListener('count', event => {
+      renderNotificationsCount(JSON.parse(event.data).count);
+    });
+    source.addEventListener('notification', event => {
+      renderNotificationsCount(JSON.parse(event.data).count);
+    });
+  }
+
   function follow(event) {
     const elem = event.target;
     const id = elem.dataset.id;
@@ -285,7 +309,7 @@ document.addEventListener('DOMContentLoaded', () => {
   }
 
   if (isAuthenticated) {
-    setInterval(updateNotificationsCount, 30000);
+    listenNotifications();
   }
 
   const tooltipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'));
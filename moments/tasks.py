@@ -0,0 +1,71 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+
+from moments.core.extensions import db
+from moments.models import Photo, PhotoVariant
+from moments.utils import generate_thumbnails
+
+PHOTO_VARIANT_COLUMNS = {'small': 'filename_s', 'medium': 'filename_m'}
+
+
+def get_image_executor(app):
+    executor = app.extensions.get('moments_image_executor')
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=app.config['MOMENTS_IMAGE_WORKERS'])
+        app.extensions['moments_image_executor'] = executor
+    return executor
+
+
+def create_photo_variants(upload_path, filename, sizes, formats):
+    """Resize the uploaded photo to each size and format, run in a worker process."""
+    return generate_thumbnails(upload_path / filename, filename, sizes, upload_path, formats)
+
+
+def save_photo_variants(photo_id, variants):
+    photo = db.session.get(Photo, photo_id)
+    if photo is None:  # deleted while processing
+        for filename in {variant[3] for variant in variants}:
+            path = current_app.config['MOMENTS_UPLOAD_PATH'] / filename
+            if path.exists():
+                path.unlink()
+        return
+    original_mimetype = next((mimetype for name, _, mimetype, _ in variants if name == 'original'), None)
+    for name, width, mimetype, filename in variants:
+        if name in PHOTO_VARIANT_COLUMNS and mimetype == original_mimetype:
+            setattr(photo, PHOTO_VARIANT_COLUMNS[name], filename)
+        photo.variants.append(PhotoVariant(name=name, width=width, mimetype=mimetype, filename=filename))
+    photo.processing = False
+    db.session.commit()
+
+
+def process_photo(photo):
+    """Create the resized variants of a photo uploaded with `processing=True`.
+
+    The photo keeps pointing at the original file until the variants are saved. The work
+    is sent to a process pool unless `MOMENTS_IMAGE_WORKERS` is 0.
+    """
+    app = current_app._get_current_object()
+    upload_path = app.config['MOMENTS_UPLOAD_PATH']
+    sizes = {
+        name: (width, app.config['MOMENTS_PHOTO_SUFFIXES'].get(width, f'_{width}'))
+        for name, width in app.config['MOMENTS_PHOTO_SIZES'].items()
+    }
+    formats = app.config['MOMENTS_PHOTO_FORMATS']
+    if not app.config['MOMENTS_IMAGE_WORKERS']:
+        save_photo_variants(photo.id, create_photo_variants(upload_path, photo.filename, sizes, formats))
+        return
+
+    photo_id = photo.id
+
+    def on_done(future):
+        with app.app_context():
+            try:
+                variants = future.result()
+            except Exception:
+                app.logger.exception(f'Failed to resize photo {photo_id}.')
+                variants = []
+            save_photo_variants(photo_id, variants)
+
+    future = get_image_executor(app).submit(create_photo_variants, upload_path, photo.filename, sizes, formats)
+    future.add_done_callback(on_done)
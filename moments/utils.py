@@ -1,13 +1,26 @@
+import contextlib
+import logging
+import mimetypes
+import os
+import re
 import uuid
+import zlib
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urljoin, urlparse
 from pathlib import Path
 
 import jwt
 import PIL
-from flask import current_app, flash, redirect, request, url_for
+from flask import abort, current_app, flash, redirect, request, url_for
 from jwt.exceptions import InvalidTokenError
 from PIL import Image
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+
+with contextlib.suppress(ImportError):
+    import pillow_avif  # noqa: F401  registers the AVIF plugin on Pillow < 11.2
+
+logger = logging.getLogger(__name__)
 
 
 def generate_token(user, operation, expiration=3600, **kwargs):
@@ -37,18 +50,99 @@ def rename_image(old_filename):
     return new_filename
 
 
-def resize_image(image, filename, base_width):
+def is_unique_filename(filename):
+    """Whether the file is named by `rename_image` or the avatar cropping, e.g. `<uuid>_s.jpg`."""
+    return re.match(r'[0-9a-f]{32}[._]', Path(filename).name) is not None
+
+
+def can_save_image_format(image_format):
+    Image.init()
+    return image_format.upper() in Image.SAVE
+
+
+def generate_thumbnails(image, filename, sizes, upload_path, formats=()):
+    """Save every size in `sizes` ({name: (width, suffix)}) with a single decode of the image.
+
+    Big JPEGs are decoded at a reduced scale with `Image.draft`, and each size is resized
+    from the previous, larger one rather than from the original. Every size is also saved
+    in the extra `formats` Pillow can write, a format that fails to encode the image is
+    logged and left out. It doesn't touch `current_app`, so it can run in the image worker
+    processes.
+
+    Return a list of (name, width, mimetype, filename), including the original image.
+    Sizes not smaller than the original point to the original file.
+    """
     ext = Path(filename).suffix
-    img = Image.open(image)
-    if img.size[0] <= base_width:
-        return filename
-    w_percent = base_width / float(img.size[0])
-    h_size = int(float(img.size[1]) * float(w_percent))
-    img = img.resize((base_width, h_size), PIL.Image.LANCZOS)
-
-    filename += current_app.config['MOMENTS_PHOTO_SUFFIXES'][base_width] + ext
-    img.save(current_app.config['MOMENTS_UPLOAD_PATH'] / filename, optimize=True, quality=85)
-    return filename
+    formats = [image_format for image_format in formats if can_save_image_format(image_format)]
+    with Image.open(image) as img:
+        width, height = img.size
+        mimetype = f'image/{img.format.lower()}'
+        variants = [('original', width, mimetype, filename)]
+        smaller_widths = [base_width for base_width, _ in sizes.values() if base_width < width]
+        if smaller_widths:
+            max_width = max(smaller_widths)
+            img.draft(img.mode, (max_width, height * max_width // width))
+
+        thumbnail = img
+        for name, (base_width, suffix) in sorted(sizes.items(), key=lambda item: item[1][0], reverse=True):
+            if width <= base_width:
+                variants.append((name, width, mimetype, filename))
+                continue
+            h_size = int(height * base_width / width)
+            thumbnail = thumbnail.resize((base_width, h_size), PIL.Image.LANCZOS)
+            thumbnail.save(Path(upload_path) / (filename + suffix + ext), optimize=True, quality=85)
+            variants.append((name, base_width, mimetype, filename + suffix + ext))
+            for image_format in formats:
+                variant = f'{filename}{suffix}.{image_format}'
+                try:
+                    thumbnail.save(Path(upload_path) / variant, optimize=True, quality=85)
+                except (OSError, ValueError):
+                    logger.exception(f'Failed to save {variant} as {image_format}.')
+                    (Path(upload_path) / variant).unlink(missing_ok=True)
+                    continue
+                variants.append((name, base_width, f'image/{image_format}', variant))
+    return variants
+
+
+def send_image(directory, filename, immutable=True):
+    """Send an uploaded image, the filenames are never reused, so it can be cached forever.
+
+    Pass `immutable=False` for the files written again under the same name, they are cached
+    for `MOMENTS_MUTABLE_IMAGE_MAX_AGE` and revalidated with the ETag after that.
+    Conditional requests are answered from the file stat only, and `MOMENTS_IMAGE_SENDFILE`
+    can hand the file over to the front proxy with `X-Sendfile` or `X-Accel-Redirect`.
+    """
+    path = safe_join(str(directory), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    stat = os.stat(path)
+    etag = f'{stat.st_mtime_ns:x}-{stat.st_size:x}-{zlib.adler32(filename.encode()):x}'
+
+    sendfile = current_app.config['MOMENTS_IMAGE_SENDFILE']
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+    elif sendfile == 'x-accel-redirect':
+        location = Path(path).relative_to(current_app.config['MOMENTS_UPLOAD_PATH']).as_posix()
+        response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['X-Accel-Redirect'] = current_app.config['MOMENTS_IMAGE_ACCEL_PREFIX'] + location
+        response.set_etag(etag)
+    else:
+        response = send_file(
+            path,
+            request.environ,
+            etag=etag,  # set before the conditional checks, so If-Range can match it
+            conditional=True,  # handles the Range header
+            use_x_sendfile=sendfile == 'x-sendfile',
+            response_class=current_app.response_class,
+        )
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.max_age = current_app.config['MOMENTS_IMAGE_MAX_AGE']
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = current_app.config['MOMENTS_MUTABLE_IMAGE_MAX_AGE']
+    return response
 
 
 def validate_image(filename):
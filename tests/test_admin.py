@@ -1,5 +1,10 @@
+from flask import Flask
+from sqlalchemy import create_engine
+
 from moments.core.extensions import db
+from moments.core.pool import InstrumentedQueuePool, init_pool
 from moments.models import Role, Tag, User
+from moments.settings import BaseConfig
 from tests import BaseTestCase
 
 
@@ -26,6 +31,29 @@ class AdminTestCase(BaseTestCase):
         self.assertEqual(response.status_code, 403)
         self.assertNotIn('Moments Dashboard', data)
 
+    def test_pool_stats(self):
+        response = self.client.get('/admin/pool-stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('default', response.get_json())
+
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool, pool_size=1)
+        with engine.connect() as connection:
+            connection.exec_driver_sql('SELECT 1')
+            stats = engine.pool.get_stats()
+            self.assertEqual(stats['checked_out'], 1)
+        stats = engine.pool.get_stats()
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(stats['checked_out'], 0)
+        engine.dispose()
+
+    def test_init_pool_keeps_config_class(self):
+        app = Flask('moments')
+        app.config.from_object(BaseConfig)
+        init_pool(app)
+        self.assertIs(app.config['SQLALCHEMY_ENGINE_OPTIONS']['poolclass'], InstrumentedQueuePool)
+        self.assertNotIn('poolclass', BaseConfig.SQLALCHEMY_ENGINE_OPTIONS)
+
     def test_edit_profile_admin(self):
         role_id = Role.query.filter_by(name='Locked').first().id
         response = self.client.post(
@@ -1,5 +1,13 @@
+from flask_login import login_user
+
 from moments.core.extensions import db
 from moments.models import Photo, User
+from moments.notifications import (
+    get_notification_writer,
+    notification_hub,
+    push_collect_notification,
+    push_follow_notification,
+)
 from tests import BaseTestCase
 
 
@@ -14,6 +22,87 @@ class AjaxTestCase(BaseTestCase):
         response = self.client.get('/ajax/notifications-count')
         self.assertEqual(response.status_code, 200)
 
+    def test_notifications_stream(self):
+        response = self.client.get('/ajax/notifications-stream')
+        self.assertEqual(response.status_code, 403)
+
+        self.login()
+        response = self.client.get('/ajax/notifications-stream', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(next(response.response), b'event: count\ndata: {"count": 0}\n\n')
+        self.assertIn(2, notification_hub._subscribers)
+        response.close()
+        self.assertNotIn(2, notification_hub._subscribers)
+
+        # a client gone before the first event doesn't leave its queue in the hub, the test
+        # client always reads the first one, so call the view
+        with self.app.test_request_context('/ajax/notifications-stream'):
+            login_user(db.session.get(User, 2))
+            response = self.app.view_functions['ajax.notifications_stream']()
+            response.close()
+        self.assertNotIn(2, notification_hub._subscribers)
+
+        self.app.config['MOMENTS_NOTIFICATION_STREAM'] = False
+        response = self.client.get('/ajax/notifications-stream')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/')
+        self.assertNotIn('data-stream-href', response.get_data(as_text=True))
+
+    def test_notification_hub(self):
+        events = notification_hub.subscribe(1)
+        try:
+            self.login()
+            self.client.post('/ajax/follow/admin')
+            event, data = events.get_nowait()
+            self.assertEqual(event, 'notification')
+            self.assertEqual(data['count'], 1)
+            self.assertIn('followed you', data['message'])
+        finally:
+            notification_hub.unsubscribe(1, events)
+
+    def test_notification_coalescing(self):
+        admin = db.session.get(User, 1)
+        with self.app.test_request_context():
+            for user_id in [2, 3, 4, 5, 5]:
+                push_collect_notification(db.session.get(User, user_id), photo_id=1, receiver=admin)
+
+        notifications = db.session.scalars(admin.notifications.select()).all()
+        self.assertEqual(len(notifications), 1)
+        self.assertEqual(notifications[0].actor_count, 4)
+        self.assertEqual([username for username, _ in notifications[0].actors], ['blocked', 'locked', 'unconfirmed'])
+        self.assertIn('and 1 other collected your', notifications[0].message)
+        self.assertEqual(admin.unread_notifications, 1)
+
+        # an actor who left the sample is still counted once
+        with self.app.test_request_context():
+            for user_id in [2, 3, 4, 5, 2, 3, 2]:
+                push_follow_notification(db.session.get(User, user_id), receiver=admin)
+        notification = db.session.scalar(admin.notifications.select().filter_by(kind='follow'))
+        self.assertEqual(notification.actor_count, 4)
+        self.assertIn('and 1 other followed you', notification.message)
+
+    def test_notification_writer(self):
+        self.app.config['MOMENTS_NOTIFICATION_ASYNC'] = True
+        admin = db.session.get(User, 1)
+        with self.app.test_request_context():
+            push_follow_notification(db.session.get(User, 2), receiver=admin)
+            push_collect_notification(db.session.get(User, 2), photo_id=1, receiver=admin)
+        self.assertEqual(admin.unread_notifications, 0)
+
+        db.session.commit()
+        get_notification_writer(self.app).close()  # flush the buffered events
+        db.session.expire_all()
+        self.assertEqual(admin.unread_notifications, 2)
+
+        # a failing event doesn't drop the rest of its batch
+        missing_user = (100, 'follow', lambda notification: 'Missing user.', None, None)
+        comment = (1, 'comment', lambda notification: 'New comment.', 1, None)
+        with self.assertLogs(self.app.logger, 'ERROR') as logs:
+            get_notification_writer(self.app)._write([missing_user, comment])
+        self.assertEqual(len(logs.records), 2)
+        db.session.expire_all()
+        self.assertEqual(admin.unread_notifications, 3)
+
     def test_get_profile(self):
         response = self.client.get('/ajax/profile/1')
         data = response.get_data(as_text=True)
@@ -1,3 +1,7 @@
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from moments.core.extensions import db
 from moments.models import User
 from moments.settings import Operations
 from moments.utils import generate_token
@@ -59,6 +63,79 @@ class AuthTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('Confirmation email sent, please check your inbox.', data)
 
+    def test_register_commits(self):
+        commits = []
+
+        def count_commit(session):
+            commits.append(session)
+
+        def register(username):
+            commits.clear()
+            self.client.post(
+                '/auth/register',
+                data=dict(
+                    name='Test',
+                    email=f'{username}@helloflask.com',
+                    username=username,
+                    password='12345678',
+                    password2='12345678',
+                ),
+            )
+            count = len(commits)
+            self.logout()
+            return count
+
+        event.listen(Session, 'after_commit', count_commit)
+        try:
+            self.app.config['MOMENTS_UNIT_OF_WORK'] = False
+            commit_per_helper = register('test1')
+            self.app.config['MOMENTS_UNIT_OF_WORK'] = True
+            unit_of_work = register('test2')
+        finally:
+            event.remove(Session, 'after_commit', count_commit)
+        self.assertEqual(unit_of_work, 1)
+        self.assertLess(unit_of_work, commit_per_helper)
+
+    def test_unit_of_work_round_trips(self):
+        # the statements and the commits (an fsync each on a file database) of the registration
+        # and follow paths, with a commit per helper and with a unit of work per request
+        counts = {'statements': 0, 'commits': 0}
+
+        def count_statement(*args):
+            counts['statements'] += 1
+
+        def count_commit(session):
+            counts['commits'] += 1
+
+        def measure(unit_of_work, username):
+            self.app.config['MOMENTS_UNIT_OF_WORK'] = unit_of_work
+            counts.update(statements=0, commits=0)
+            data = dict(name='Test', email=f'{username}@helloflask.com', username=username, password='12345678')
+            self.client.post('/auth/register', data=dict(data, password2='12345678'))
+            register = dict(counts)
+
+            db.session.scalar(select(User).filter_by(username=username)).confirmed = True
+            db.session.commit()
+            counts.update(statements=0, commits=0)
+            for followed in ['admin', 'normal', 'unconfirmed']:
+                self.client.post(f'/user/follow/{followed}')
+                self.client.post(f'/user/unfollow/{followed}')
+            follow = dict(counts)
+            self.logout()
+            return register, follow
+
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        event.listen(Session, 'after_commit', count_commit)
+        try:
+            commit_per_helper = measure(False, 'test1')
+            unit_of_work = measure(True, 'test2')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+            event.remove(Session, 'after_commit', count_commit)
+        for before, after in zip(commit_per_helper, unit_of_work):
+            self.assertLess(after['commits'], before['commits'])
+            self.assertLess(after['statements'], before['statements'])
+
     def test_confirm_account(self):
         user = User.query.filter_by(email='unconfirmed@helloflask.com').first()
         self.assertFalse(user.confirmed)
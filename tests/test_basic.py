@@ -1,5 +1,9 @@
-from flask import current_app
+from flask import current_app, g
+from sqlalchemy import select, update
 
+from moments.core.extensions import db
+from moments.decorators import primary_only
+from moments.models import User
 from tests import BaseTestCase
 
 
@@ -15,3 +19,41 @@ class BasicTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertEqual(response.status_code, 404)
         self.assertIn('404 Error', data)
+
+    def test_replica_routing(self):
+        self.app.config['MOMENTS_REPLICA_BINDS'] = ['replica']
+        with self.app.test_request_context('/', method='GET'):
+            self.assertEqual(db.session().get_replica_bind(select(User)), 'replica')
+            self.assertIsNone(db.session().get_replica_bind(update(User).values(confirmed=True)))
+            self.assertIsNone(db.session().get_replica_bind(select(User)))  # read your writes
+
+        with self.app.test_request_context('/', method='POST'):
+            self.assertIsNone(db.session().get_replica_bind(select(User)))
+
+        g.pop('use_primary')  # `g` belongs to the app context pushed in setUp
+        with self.app.test_request_context('/', method='GET'):
+            self.assertEqual(db.session().get_replica_bind(select(User)), 'replica')
+            primary_only(lambda: None)()
+            self.assertIsNone(db.session().get_replica_bind(select(User)))
+
+    def test_primary_pinned_after_write(self):
+        self.login()
+        self.app.config['MOMENTS_REPLICA_BINDS'] = ['replica']
+        response = self.client.post('/user/follow/admin')
+        self.assertIn('moments_primary=1', response.headers['Set-Cookie'])
+        self.assertIn('Max-Age=5', response.headers['Set-Cookie'])
+
+        g.pop('use_primary', None)
+        with self.app.test_request_context('/', method='GET', headers={'Cookie': 'moments_primary=1'}):
+            self.app.preprocess_request()
+            self.assertIsNone(db.session().get_replica_bind(select(User)))
+
+    def test_query_profiler(self):
+        self.login()
+        response = self.client.get('/')
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+
+        self.app.config['MOMENTS_QUERY_BUDGET'] = 0
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/')
+        self.assertIn('Query budget exceeded: main.index', logs.output[0])
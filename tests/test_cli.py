@@ -1,3 +1,5 @@
+from datetime import datetime, timedelta, timezone
+
 from moments.core.extensions import db
 from moments.models import Comment, Photo, Role, Tag, User
 from tests import BaseTestCase
@@ -62,3 +64,57 @@ class CLITestCase(BaseTestCase):
 
         self.assertEqual(Comment.query.count(), 10)
         self.assertIn('Generated 10 comments.', result.output)
+
+    def test_recount_command(self):
+        db.create_all()
+        Role.init_role()
+        user = User(email='test@helloflask.com', name='Test', username='test', password='123')
+        photo = Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg', author=user)
+        comment = Comment(body='test comment body', photo=photo, author=user)
+        tag = Tag(name='test')
+        photo.tags.append(tag)
+        db.session.add_all([user, photo, comment])
+        db.session.commit()
+        self.assertEqual(user.photos_count, 1)
+        self.assertEqual(photo.comments_count, 1)
+        self.assertEqual(tag.photos_count, 1)
+
+        user.photos_count = 10
+        photo.comments_count = 10
+        tag.photos_count = 10
+        db.session.commit()
+
+        result = self.cli_runner.invoke(args=['recount'])
+        self.assertIn('Recounted the statistics.', result.output)
+        db.session.expire_all()
+        self.assertEqual(user.photos_count, 1)
+        self.assertEqual(user.followers_count, 0)
+        self.assertEqual(photo.comments_count, 1)
+        self.assertEqual(tag.photos_count, 1)
+
+    def test_refresh_trending_command(self):
+        db.create_all()
+        Role.init_role()
+        user = User(email='test@helloflask.com', name='Test', username='test', password='123')
+        old_tag = Tag(name='old')
+        new_tag = Tag(name='new')
+        old_photo = Photo(filename='old.jpg', filename_s='old_s.jpg', filename_m='old_m.jpg', author=user)
+        old_photo.created_at = datetime.now(timezone.utc) - timedelta(days=30)
+        old_photo.tags.extend([old_tag, new_tag])
+        new_photo = Photo(filename='new.jpg', filename_s='new_s.jpg', filename_m='new_m.jpg', author=user)
+        new_photo.tags.append(new_tag)
+        db.session.add_all([old_photo, new_photo])
+        db.session.commit()
+
+        result = self.cli_runner.invoke(args=['refresh-trending'])
+        self.assertIn('Refreshed the trending tags.', result.output)
+        db.session.expire_all()
+        self.assertEqual(old_tag.trending_count, 0)
+        self.assertEqual(new_tag.trending_count, 1)
+        self.assertEqual(Tag.get_top_tags(10), [new_tag, old_tag])
+        self.assertEqual(Tag.get_top_tags(10, trending=True), [new_tag])
+
+    def test_benchmark_sqlite_command(self):
+        result = self.cli_runner.invoke(args=['benchmark-sqlite', '--seconds', '1', '--readers', '1'])
+        self.assertIn('default:', result.output)
+        self.assertIn('tuned:', result.output)
@@ -1,8 +1,21 @@
 import io
+import re
+import tempfile
+import time
+import uuid
 from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
 
+from PIL import Image as PILImage
+
+from moments.cache import CSRF_PLACEHOLDER, FileSystemStore, ResponseCache, SQLiteStore, get_response_cache
 from moments.core.extensions import db
-from moments.models import Comment, Notification, Photo, Tag, User
+from moments.core.templating import get_fragment_cache_stats
+from moments.models import Comment, Notification, Photo, Tag, Timeline, User
+from moments.notifications import delete_notifications, read_notifications
+from moments.pagination import encode_cursor
+from moments.utils import can_save_image_format, generate_thumbnails, is_unique_filename
 from tests import BaseTestCase
 
 
@@ -18,10 +31,57 @@ class MainTestCase(BaseTestCase):
         self.assertNotIn('Join Now', data)
         self.assertIn('My Home', data)
 
+    def test_timeline(self):
+        self.login()
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('No trends.', data)
+
+        normal = db.session.get(User, 2)
+        admin = db.session.get(User, 1)
+        normal.follow(admin)
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('Photo 1', data)
+
+        normal.unfollow(admin)
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertNotIn('Photo 1', data)
+
+    def test_timeline_push_after_pull(self):
+        self.app.config['MOMENTS_TIMELINE_FANOUT_LIMIT'] = 1
+        admin = db.session.get(User, 1)
+        normal = db.session.get(User, 2)
+        locked = db.session.get(User, 4)
+        normal.follow(admin)
+        locked.follow(admin)
+        self.assertTrue(Timeline.is_pulled(admin))
+        photo = Photo(filename='new.jpg', filename_s='new_s.jpg', filename_m='new_m.jpg', author=admin)
+        db.session.add(photo)
+        db.session.flush()
+        Timeline.push_photo(photo)
+        db.session.commit()
+        self.assertIsNone(db.session.get(Timeline, (2, photo.id)))
+
+        locked.unfollow(admin)
+        self.assertFalse(Timeline.is_pulled(admin))
+        self.assertIsNotNone(db.session.get(Timeline, (2, photo.id)))
+        self.assertIsNotNone(db.session.get(Timeline, (2, 1)))
+
     def test_explore_page(self):
         response = self.client.get('/explore')
         data = response.get_data(as_text=True)
         self.assertIn('Change', data)
+        self.assertIn('/photo/1"', data)
+        self.assertIn('/photo/2"', data)
+
+        db.session.delete(db.session.get(Photo, 1))
+        db.session.commit()
+        response = self.client.get('/explore')
+        data = response.get_data(as_text=True)
+        self.assertNotIn('/photo/1"', data)
+        self.assertIn('/photo/2"', data)
 
     def test_search(self):
         response = self.client.get('/search?q=', follow_redirects=True)
@@ -62,6 +122,33 @@ class MainTestCase(BaseTestCase):
         self.assertNotIn('test 1', data)
         self.assertIn('test 2', data)
 
+    def test_notifications_cursor_pagination(self):
+        user = db.session.get(User, 2)
+        notifications = [Notification(message=f'message {i:02d}', receiver=user) for i in range(25)]
+        db.session.add_all(notifications)
+        db.session.commit()
+
+        self.login()
+        response = self.client.get('/notifications')
+        data = response.get_data(as_text=True)
+        self.assertIn('message 24', data)
+        self.assertNotIn('message 04', data)
+        self.assertIn('cursor=', data)
+
+        next_url = re.search(r'href="([^"]*cursor=[^"]*)">Next', data).group(1).replace('&amp;', '&')
+        response = self.client.get(next_url)
+        data = response.get_data(as_text=True)
+        self.assertIn('message 04', data)
+        self.assertNotIn('message 05', data)
+
+        response = self.client.get('/notifications?cursor=invalid')
+        self.assertEqual(response.status_code, 400)
+
+        for values in [[1], {'a': 1}, True, '2']:
+            cursor = encode_cursor('next', [values, 2])
+            response = self.client.get(f'/explore?order_rule=collections&cursor={cursor}')
+            self.assertEqual(response.status_code, 400)
+
     def test_read_notification(self):
         user = db.session.get(User, 2)
         notification1 = Notification(message='test 1', receiver=user)
@@ -81,6 +168,7 @@ class MainTestCase(BaseTestCase):
         self.assertIn('Notification archived.', data)
 
         self.assertTrue(db.session.get(Notification, 1).is_read)
+        self.assertEqual(user.unread_notifications, 1)
 
     def test_read_all_notification(self):
         user = db.session.get(User, 2)
@@ -97,6 +185,113 @@ class MainTestCase(BaseTestCase):
 
         self.assertTrue(db.session.get(Notification, 1).is_read)
         self.assertTrue(db.session.get(Notification, 2).is_read)
+        self.assertEqual(user.unread_notifications, 0)
+
+        response = self.client.get('/ajax/notifications-count')
+        self.assertEqual(response.get_json()['count'], 0)
+
+    def test_delete_read_notification(self):
+        user = db.session.get(User, 2)
+        old = datetime.now() - timedelta(days=10)
+        notification1 = Notification(message='test 1', receiver=user, created_at=old)
+        notification2 = Notification(message='test 2', receiver=user)
+        db.session.add_all([notification1, notification2])
+        db.session.commit()
+
+        self.assertEqual(read_notifications(user, days=7), 1)
+        self.assertEqual(user.unread_notifications, 1)
+
+        self.login()
+        response = self.client.post('/notifications/delete/read', follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('1 read notifications deleted.', data)
+        self.assertIsNone(db.session.get(Notification, 1))
+
+        self.assertEqual(delete_notifications(user), 1)
+        self.assertEqual(user.unread_notifications, 0)
+
+    def test_response_cache(self):
+        self.app.config['MOMENTS_RESPONSE_CACHE'] = True
+        response = self.client.get('/photo/1')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        response = self.client.get('/photo/1')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertNotIn(CSRF_PLACEHOLDER, response.get_data(as_text=True))
+
+        comment = Comment(body='new comment body', photo=db.session.get(Photo, 1), author=db.session.get(User, 2))
+        db.session.add(comment)
+        db.session.commit()
+        response = self.client.get('/photo/1')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn('new comment body', response.get_data(as_text=True))
+
+        # made up query string arguments don't add entries
+        response = self.client.get('/photo/1?foo=bar')
+        self.assertNotIn('X-Cache', response.headers)
+
+        self.login()
+        response = self.client.get('/photo/1')
+        self.assertNotIn('X-Cache', response.headers)
+
+    def test_response_cache_versions(self):
+        self.app.config['MOMENTS_RESPONSE_CACHE'] = True
+        cache = get_response_cache(self.app)
+        comment = Comment(body='comment body', photo=db.session.get(Photo, 1), author=db.session.get(User, 2))
+        db.session.add(comment)
+        db.session.commit()
+        self.assertIsNotNone(cache.get_version('photo:1'))
+        self.assertIsNone(cache.get_version(f'comment:{comment.id}'))  # no page reads the comment rows
+
+        cache = ResponseCache(maxsize=10, ttl=60, version_ttl=10, purge_interval=0)
+        cache.set('key', 'value', tags=['photo:1'], ttl=60)
+        cache.invalidate('photo:1')
+        self.assertEqual(len(cache._versions), 1)
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertIsNone(cache.local.get('key'))  # never cached longer than the versions
+            cache.invalidate('photo:2')
+        self.assertEqual(list(cache._versions), ['photo:2'])
+
+    def test_response_cache_stores(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for store in [FileSystemStore(Path(directory) / 'cache'), SQLiteStore(Path(directory) / 'cache.db')]:
+                cache = ResponseCache(maxsize=0, ttl=60, shared=store)
+                cache.set('key', {'body': b'body'}, tags=['photo:1'])
+                self.assertEqual(cache.get('key')['body'], b'body')
+                cache.invalidate('photo:1')
+                self.assertIsNone(cache.get('key'))
+
+        with tempfile.TemporaryDirectory() as directory:
+            for store in [
+                FileSystemStore(Path(directory) / 'cache', maxsize=2),
+                SQLiteStore(Path(directory) / 'cache.db', maxsize=2),
+            ]:
+                store.set('expired', 'value', ttl=-1)
+                for i in range(3):
+                    store.set(f'key{i}', 'value', ttl=60 + i)
+                store.set('version:photo:1', 'version', ttl=30)
+                store.purge()
+                self.assertIsNone(store.get('key0'))  # the earliest to expire beyond the size
+                self.assertEqual(store.get('key2'), 'value')
+                self.assertEqual(store.get('version:photo:1'), 'version')
+                if isinstance(store, FileSystemStore):
+                    self.assertEqual(len(list(store.path.iterdir())), 3)
+                else:
+                    self.assertEqual(store._connection.execute('SELECT count(*) FROM cache').fetchone()[0], 3)
+
+    def test_fragment_cache(self):
+        self.app.config['MOMENTS_FRAGMENT_CACHE'] = True
+        self.client.get('/photo/1')
+        response = self.client.get('/photo/1')
+        self.assertIn('test tag', response.get_data(as_text=True))
+        stats = get_fragment_cache_stats(self.app)
+        self.assertEqual(stats['photo-tags'], {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+        photo = db.session.get(Photo, 1)
+        photo.tags.append(Tag(name='new tag'))
+        db.session.commit()
+        response = self.client.get('/photo/1')
+        self.assertIn('new tag', response.get_data(as_text=True))
+        self.assertEqual(get_fragment_cache_stats(self.app)['photo-tags']['misses'], 2)
 
     def test_show_photo(self):
         response = self.client.get('/photo/1', follow_redirects=True)
@@ -268,6 +463,25 @@ class MainTestCase(BaseTestCase):
         self.assertEqual(db.session.get(Photo, 1).tags[3].name, 'pet')
         self.assertEqual(db.session.get(Photo, 1).tags[4].name, 'happy')
 
+        self.client.post('/photo/1/tag/new', data=dict(tag='dog cat'))
+        tags = {tag.name: tag for tag in db.session.get(Photo, 1).tags}
+        self.assertEqual(len(tags), 6)
+        self.assertEqual(tags['dog'].photos_count, 1)
+        self.assertEqual(tags['cat'].photos_count, 1)
+        response = self.client.get('/search?q=cat&category=tag')
+        self.assertIn('cat', response.get_data(as_text=True))
+
+    def test_created_tags_indexed_on_commit(self):
+        Tag.get_or_create(['rolled back'])
+        db.session.rollback()
+        self.assertNotIn('created_tags', db.session.info)
+
+        Tag.get_or_create(['kitten', 'puppy'])
+        self.assertEqual(Tag.query.whooshee_search('kitten').all(), [])  # not committed yet
+        db.session.commit()
+        self.assertEqual([tag.name for tag in Tag.query.whooshee_search('kitten')], ['kitten'])
+        self.assertEqual([tag.name for tag in Tag.query.whooshee_search('puppy')], ['puppy'])
+
     def test_set_comment(self):
         self.login()
         response = self.client.post('/set-comment/1', follow_redirects=True)
@@ -315,6 +529,16 @@ class MainTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('Order by collections', data)
 
+    def test_order_by_collections(self):
+        photo = db.session.get(Photo, 2)
+        photo.tags.append(db.session.get(Tag, 1))
+        db.session.get(User, 2).collect(photo)
+
+        for url in ['/tag/1', '/explore']:
+            response = self.client.get(url + '?order_rule=collections')
+            data = response.get_data(as_text=True)
+            self.assertLess(data.index('/photo/2"'), data.index('/photo/1"'))
+
     def test_delete_tag(self):
         photo = db.session.get(Photo, 2)
         tag = Tag(name='test')
@@ -342,3 +566,86 @@ class MainTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertEqual(response.status_code, 400)
         self.assertIn('Invalid image.', data)
+
+    def test_upload_image_variants(self):
+        self.login()
+        image = io.BytesIO()
+        PILImage.new('RGB', (1000, 500)).save(image, 'JPEG')
+        image.seek(0)
+        response = self.client.post('/upload', data=dict(file=(image, 'test.jpg')))
+        self.assertEqual(response.status_code, 200)
+
+        photo = db.session.get(Photo, 3)
+        self.assertFalse(photo.processing)
+        self.assertNotEqual(photo.filename_s, photo.filename)
+        self.assertNotEqual(photo.filename_m, photo.filename)
+        upload_path = self.app.config['MOMENTS_UPLOAD_PATH']
+        with PILImage.open(upload_path / photo.filename_s) as img:
+            self.assertEqual(img.size, (400, 200))
+        with PILImage.open(upload_path / photo.filename_m) as img:
+            self.assertEqual(img.size, (800, 400))
+        with self.app.test_request_context():
+            self.assertIn('400w', photo.srcset())
+
+        if can_save_image_format('webp'):
+            with self.app.test_request_context():
+                self.assertIn('400w', photo.srcset('image/webp'))
+            response = self.client.get(f'/images/{photo.filename_s}', headers={'Accept': 'image/webp,*/*'})
+            self.assertEqual(response.mimetype, 'image/webp')
+            response.close()
+        response = self.client.get(f'/images/{photo.filename_s}', headers={'Accept': '*/*'})
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertTrue(response.cache_control.immutable)
+        self.assertIn('Accept', response.vary)
+        response.close()
+        db.session.delete(photo)  # remove the saved files
+        db.session.commit()
+
+    def test_image_variant_format_failure(self):
+        image = io.BytesIO()
+        PILImage.new('RGB', (1000, 500)).save(image, 'JPEG')
+        image.seek(0)
+        save = PILImage.Image.save
+
+        def save_or_fail(img, fp, *args, **kwargs):
+            if str(fp).endswith('.webp'):
+                raise OSError('cannot write mode as WEBP')
+            return save(img, fp, *args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as upload_path, mock.patch.object(PILImage.Image, 'save', save_or_fail):
+            with self.assertLogs('moments.utils', 'ERROR'):
+                variants = generate_thumbnails(image, 'test.jpg', {'small': (400, '_s')}, upload_path, ['webp'])
+            self.assertEqual([variant[2] for variant in variants], ['image/jpeg', 'image/jpeg'])
+            self.assertEqual([path.name for path in Path(upload_path).iterdir()], ['test.jpg_s.jpg'])
+
+    def test_get_avatar_caching(self):
+        user = db.session.get(User, 1)
+        response = self.client.get(f'/avatars/{user.avatar_s}')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.cache_control.immutable)  # an identicon, drawn again on renames
+        self.assertEqual(response.cache_control.max_age, 60)
+        self.assertTrue(is_unique_filename(f'{uuid.uuid4().hex}_s.png'))  # a cropped avatar
+        self.assertFalse(is_unique_filename(user.avatar_s))
+        etag, weak = response.get_etag()
+        self.assertFalse(weak)
+        response.close()
+
+        response = self.client.get(f'/avatars/{user.avatar_s}', headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        response = self.client.get(f'/avatars/{user.avatar_s}', headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(len(response.data), 10)
+        response.close()
+
+        response = self.client.get(f'/avatars/{user.avatar_s}', headers={'Range': 'bytes=0-9', 'If-Range': f'"{etag}"'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.get_etag(), (etag, False))
+        response.close()
+        response = self.client.get(f'/avatars/{user.avatar_s}', headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        response = self.client.get('/avatars/missing.png')
+        self.assertEqual(response.status_code, 404)
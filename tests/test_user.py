@@ -1,7 +1,7 @@
 import io
 
 from moments.core.extensions import db
-from moments.models import Photo, User
+from moments.models import Photo, Role, Tag, User
 from moments.settings import Operations
 from moments.utils import generate_token
 from tests import BaseTestCase
@@ -55,7 +55,7 @@ class UserTestCase(BaseTestCase):
         self.assertIn('Already followed.', data)
 
         user = db.session.get(User, 1)
-        self.assertEqual(user.notifications_count, 1)
+        self.assertEqual(user.unread_notifications, 1)
 
     def test_unfollow(self):
         response = self.client.post('/user/follow/admin', follow_redirects=True)
@@ -75,6 +75,46 @@ class UserTestCase(BaseTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn('User unfollowed.', data)
 
+    def test_preload_relationships(self):
+        admin = db.session.get(User, 1)
+        normal = db.session.get(User, 2)
+        photo = db.session.get(Photo, 1)
+        normal.follow(admin)
+        normal.collect(photo)
+
+        with self.app.test_request_context():
+            normal.preload_relationships(photos=[photo], users=[admin])
+            self.assertTrue(normal.is_following(admin))
+            self.assertFalse(normal.is_followed_by(admin))
+            self.assertTrue(normal.is_collecting(photo))
+
+            normal.unfollow(admin)
+            self.assertFalse(normal.is_following(admin))
+
+    def test_permission_cache(self):
+        user = db.session.get(User, 2)
+        self.assertTrue(user.can('UPLOAD'))
+        self.assertFalse(user.can('ADMIN'))
+
+        user.role.permissions = [p for p in user.role.permissions if p.name != 'UPLOAD']
+        db.session.flush()
+        self.assertTrue(user.can('UPLOAD'))  # not committed yet
+        db.session.rollback()
+        self.assertTrue(user.can('UPLOAD'))
+
+        user.role.permissions = [p for p in user.role.permissions if p.name != 'UPLOAD']
+        db.session.commit()
+        self.assertFalse(user.can('UPLOAD'))
+
+        Role.init_role()
+        self.assertTrue(user.can('UPLOAD'))
+
+        # giving a user a role doesn't change the map
+        permission_map = self.app.extensions['moments_role_permissions']
+        user.lock()
+        self.assertFalse(user.can('UPLOAD'))
+        self.assertIs(self.app.extensions['moments_role_permissions'], permission_map)
+
     def test_show_followers(self):
         response = self.client.get('/user/normal/followers')
         data = response.get_data(as_text=True)
@@ -190,7 +230,7 @@ class UserTestCase(BaseTestCase):
         self.client.post('/user/follow/normal')
         self.client.post('/2/comment/new', data=dict(body='test comment from admin user.'))
         self.client.post('/collect/2')
-        self.assertEqual(user.notifications_count, 0)
+        self.assertEqual(user.unread_notifications, 0)
 
     def test_privacy_setting(self):
         self.login()
@@ -225,3 +265,24 @@ class UserTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('Your are free, goodbye!', data)
         self.assertEqual(db.session.get(User, 2), None)
+
+    def test_delete_account_counters(self):
+        admin = db.session.get(User, 1)
+        normal = db.session.get(User, 2)
+        photo = db.session.get(Photo, 1)
+        tag = db.session.get(Tag, 1)
+        photo2 = db.session.get(Photo, 2)
+        photo2.tags.append(tag)
+        normal.follow(admin)
+        normal.collect(photo)
+        self.assertEqual(admin.followers_count, 1)
+        self.assertEqual(photo.collectors_count, 1)
+        self.assertEqual(photo.comments_count, 1)
+        self.assertEqual(tag.photos_count, 2)
+
+        db.session.delete(normal)
+        db.session.commit()
+        self.assertEqual(admin.followers_count, 0)
+        self.assertEqual(photo.collectors_count, 0)
+        self.assertEqual(photo.comments_count, 0)
+        self.assertEqual(tag.photos_count, 1)